@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides the batched sqlite writer of the delta phases.
+
+A phase writes all of its batches in one transaction, with a savepoint around
+each batch so that a failed batch can be undone on its own, instead of paying
+for a commit, and so an fsync, per batch. Batch sizes adapt to the observed
+throughput so that a batch takes about TARGET_SECONDS, within a memory budget
+and below a cap such as the --batch_size option.
+"""
+
+# Standard Python modules
+import logging
+import time
+
+# Seconds a batch should take, from reading its rows to writing them.
+TARGET_SECONDS = 0.5
+
+# Bytes of source data a batch may hold, when the caller can tell.
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+MIN_BATCH_SIZE = 100
+INITIAL_BATCH_SIZE = 1000
+
+# Cap on batch sizes when none is given.
+MAX_BATCH_SIZE = 10 * 1000
+
+def batch_cap(options):
+    """Returns the largest batch size allowed by options."""
+    return getattr(options, 'batch_size', None) or MAX_BATCH_SIZE
+
+class BatchWriter(object):
+    """Writes a phase in a single transaction of savepointed batches.
+
+    Use it as a context manager around the phase: the transaction is
+    committed when the block ends and rolled back if it raises. size is the
+    number of rows the next batch should have.
+    """
+
+    def __init__(self, conn, name, cap=MAX_BATCH_SIZE, checkpoint=None):
+        """If checkpoint is given, the transaction is also committed once that
+        many seconds have passed since the last commit, so an interrupted phase
+        keeps what it wrote before."""
+        self.conn = conn
+        self.name = name
+        self.cap = cap
+        self.floor = min(MIN_BATCH_SIZE, cap)
+        self.size = min(INITIAL_BATCH_SIZE, cap)
+        self.checkpoint = checkpoint
+        self.sizes = []
+        self.isolation_level = None
+        self.last = None
+        self.committed = None
+
+    def __enter__(self):
+        # Savepoints need transactions controlled here, not by the sqlite3 module:
+        self.isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        self.conn.execute('begin')
+        self.last = self.committed = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.conn.execute('commit')
+                self.report()
+            else:
+                self.conn.execute('rollback')
+        finally:
+            self.conn.isolation_level = self.isolation_level
+        return False
+
+    def savepoint(self):
+        """Starts a batch."""
+        self.conn.execute('savepoint batch')
+
+    def release(self, rowcount, nbytes=None):
+        """Ends a batch of rowcount rows holding about nbytes bytes of source
+        data, and sizes the next one."""
+        self.conn.execute('release batch')
+        self.resize(rowcount, nbytes)
+        if self.checkpoint is not None and self.last - self.committed >= self.checkpoint:
+            self.conn.execute('commit')
+            self.conn.execute('begin')
+            self.committed = self.last
+
+    def rollback(self):
+        """Undoes a batch, leaving the earlier ones of the phase in place."""
+        self.conn.execute('rollback to batch')
+        self.conn.execute('release batch')
+        self.last = time.time()
+
+    def executemany(self, cursor, sql, rows, nbytes=None):
+        """Runs sql for every row of a batch."""
+        self.savepoint()
+        try:
+            cursor.executemany(sql, rows)
+        except:
+            self.rollback()
+            raise
+        self.release(len(rows), nbytes)
+
+    def resize(self, rowcount, nbytes=None):
+        """Sizes the next batch from the time the last one of rowcount rows
+        took. Sizes change at most twofold per batch, except to stay within
+        the memory budget."""
+        now = time.time()
+        elapsed = now - self.last
+        self.last = now
+        self.sizes.append(rowcount)
+        if rowcount <= 0:
+            return
+        size = self.size
+        if elapsed > 0:
+            size = int(rowcount / elapsed * TARGET_SECONDS)
+        size = max(self.size / 2, min(2 * self.size, size))
+        if nbytes:
+            size = min(size, int(MEMORY_BUDGET * rowcount / nbytes))
+        self.size = max(self.floor, min(self.cap, size))
+
+    def report(self):
+        if self.sizes:
+            logging.info('%s: %s rows in %s batches of %s to %s rows' % (
+                    self.name, sum(self.sizes), len(self.sizes), min(self.sizes), max(self.sizes)))
@@ -22,9 +22,9 @@ __contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
 
 # VertNet modules
 from utils import UnicodeDictReader
+import partitions
 
 # Standard Python modules
-import codecs
 import csv
 import logging
 import shlex
@@ -102,12 +102,17 @@ class Bulkload(object):
                 recindex_db_filename = line.split(':')[3].strip()
 
         # Update cache.recstate to published or error
-        conn = sqlite3.connect('bulk.sqlite3.db', check_same_thread=False)
+        partition = partitions.get_partition(self.options)
+        dbfile = partition.dbfile if partition else partitions.DB_FILE
+        conn = sqlite3.connect(dbfile, check_same_thread=False)
         cur = conn.cursor()
         values = self._reckeys_not_bulkloaded(rec_db_filename, recindex_db_filename)
         sql = 'update cache set recstate=? where reckey=?'
         recs = cur.executemany(sql, values)
         conn.commit()
+        conn.close()
+        if partition:
+            partition.unlock()
 
         # Set appid and couchdb based dev_server or production
         if self.options.url.rfind('localhost') != -1:
@@ -134,7 +139,7 @@ class Bulkload(object):
         rows = []
         count = 0
         logging.info('batch_size=%s' % batch_size)
-        f = codecs.open(self.options.filename, encoding='utf-8', mode='r')
+        f = open(self.options.filename, 'rb')
         for row in UnicodeDictReader(f):            
             if count > batch_size:
                 logging.info('yield!')
@@ -173,7 +178,7 @@ class Bulkload(object):
         indexes = index_cur.execute('select state from progress')
         
         # Get reader for report.csv
-        f = codecs.open(self.options.filename, encoding='utf-8', mode='r')
+        f = open(self.options.filename, 'rb')
         report = UnicodeDictReader(f, skipinitialspace=True)
                 
         # Yield (state, reckey)
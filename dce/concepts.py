@@ -512,6 +512,25 @@ def transform(name, value):
         except:
             pass
     
+def _to_int(value):
+    try:
+        return int(float(value))
+    except:
+        return None
+
+def _to_float(value):
+    try:
+        return float(value)
+    except:
+        return None
+
+CONVERTERS = {int: _to_int, float: _to_float}
+
+def get_converter(name):
+    """Returns the function that types values of concept name like transform,
+    or None if its values stay strings."""
+    return CONVERTERS.get(NAME_TYPES.get(get_full_name(name)))
+
 def get_full_name(name):
     if not name:
         return None
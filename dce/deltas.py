@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-# Copyright 2011 The Regents of the University of California 
+# Copyright 2011 The Regents of the University of California
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
 # you may not use this file except in compliance with the License.
@@ -21,323 +21,1215 @@ __contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
 """This module provides support for calculating CSV file deltas."""
 
 # DCE modules
-from utils import UnicodeDictReader, UnicodeDictWriter
+from batches import BatchWriter, batch_cap
+from utils import DigestSet, ExternalSort, OffsetDictReader, RowDecoder, UnicodeDictWriter, chunk_csv, detect_encoding, is_bytewise, is_compressed, open_csv, read_csv_range, split_csv, transcode
 import concepts
+import dwca
+import keys
+import partitions
+import rechash
+import records
+import schema
 
 # Standard Python modules
-import codecs
+import collections
 import csv
-import hashlib
+import gzip
 import logging
+import multiprocessing
+import os
+import Queue
+import shutil
 import simplejson
 import sqlite3
 import sys
+import threading
 
-# Datastore Plus
-from ndb import model
+# Name of the plain copy of the CSV file made next to the cache when rows are
+# read out of order or need transcoding.
+INPUT_FILE = 'input.csv'
 
+# Rows per page of iter_cache.
 BATCH_SIZE = 10 * 1000
 
+# Duplicate source_ids logged one by one before only counting them.
+DUPLICATES_LOGGED = 10
+
+# Seconds between commits of the ingest phase, which bound the work an
+# interrupted run has to redo with --resume.
+CHECKPOINT_SECONDS = 10
+
+# Size in bytes of the CSV ranges parsed by each task of a worker pool.
+RANGE_SIZE = 4 * 1024 * 1024
+
+# Number of rows sampled to train a dictionary for compact records.
+DICTIONARY_SAMPLE = 10 * 1000
+
+# Bits of a line's CRC-32 that must be zero to end a content-defined chunk, so
+# chunks have about 1024 lines.
+CHUNK_MASK = 1023
+
+# Number of rows sorted in memory per run by the sort-merge engine.
+SORT_RUN_SIZE = 500 * 1000
+
+STAGING_TABLE = 'staging'
+
+# A cache row as yielded by DeltaProcessor.iter_changes. rechash is in hex, rec
+# is the decoded record dictionary and recfields a tuple of the names changed
+# by an update, or None if unknown.
+Change = collections.namedtuple('Change', 'recstate reckey rechash rec recfields')
+
+CHANGED_STATES = ('new', 'updated', 'deleted')
+
+def staged_batches(conn, sql, writer):
+    """Generator for lists of at most writer.size rows selected by sql.
+
+    The rows are first copied into a temporary staging table by sqlite, then
+    paged out by rowid. No cursor stays open between batches, so callers can
+    write to the tables joined in sql while consuming batches, and memory is
+    bounded by the batch size no matter how many rows sql returns.
+    """
+    cursor = conn.cursor()
+    cursor.execute('drop table if exists temp.%s' % STAGING_TABLE)
+    cursor.execute('create temp table %s as %s' % (STAGING_TABLE, sql))
+    pagesql = 'select rowid, * from temp.%s where rowid > ? order by rowid limit ?' \
+        % STAGING_TABLE
+    lastrowid = 0
+    try:
+        while True:
+            rows = cursor.execute(pagesql, (lastrowid, writer.size)).fetchall()
+            if not rows:
+                break
+            lastrowid = rows[-1][0]
+            yield [row[1:] for row in rows]
+    finally:
+        cursor.execute('drop table if exists temp.%s' % STAGING_TABLE)
+
+def update_fields(recstate, recfields, oldhashes, newhashes):
+    """Returns the comma separated names changed by updating a cache row, or
+    None if they are unknown.
+
+    Changes accumulate in recfields until the row is published. Rows never
+    published, or cached without field hashes, have unknown changed fields.
+    """
+    if not oldhashes:
+        return None
+    if recstate == 'published':
+        changed = set()
+    elif recstate == 'updated' and recfields is not None:
+        changed = set(recfields.split(','))
+    else:
+        return None
+    changed.update(rechash.changed_fields(oldhashes, newhashes))
+    return ','.join(sorted(changed))
+
+class RowProcessor(object):
+    """Turns batches of (offset, values) pairs into tmp and tmphash rows.
+
+    Rows are tuples of values in the column order of the CSV header, which is
+    compiled once into a rechash.ColumnPlan set as plan before the first call.
+    Instances only hold plain values, so they can be pickled and called by
+    worker processes as well as in process.
+    """
+
+    def __init__(self, options, prevversions, codec=None):
+        self.publisher_name = options.publisher_name
+        self.collection_name = options.collection_name
+        self.source_id = options.source_id
+        self.two_phase = getattr(options, 'two_phase', False)
+        self.prevversions = prevversions
+        self.codec = codec
+        self.plan = None
+        self.keys = keys.RecordKeyEncoder(self.publisher_name, self.collection_name)
+        self.decoder = RowDecoder(getattr(options, 'encoding', None) or 'utf-8')
+
+    @staticmethod
+    def get_rec(row):
+        rec = {}
+        for name,value in row.iteritems():
+            full_name = concepts.get_full_name(name)
+            if not full_name: # Skip non-dwc names
+                continue
+            typed_value = concepts.transform(full_name, value)
+            if typed_value:
+                value = typed_value
+            else:
+                pass # TODO: Candidate for validation?
+            rec[full_name] = value
+        return rec
+
+    def get_planned_rec(self, values):
+        """Returns get_rec() of the row of values."""
+        rec = {}
+        for i, full_name, convert in self.plan.concepts:
+            value = values[i]
+            typed_value = convert(value) if convert else value
+            if typed_value:
+                value = typed_value
+            rec[full_name] = value
+        return rec
+
+    def encode(self, rec):
+        """Returns the recjson of rec, compact if the processor has a codec."""
+        if self.codec:
+            return self.codec.encode(rec)
+        return simplejson.dumps(rec)
+
+    def recjson(self, values):
+        """Returns the recjson of the row of values."""
+        return self.encode(self.get_planned_rec(values))
+
+    def __call__(self, rows):
+        """Returns (tmp rows, tmphash rows) for a list of (offset, values) pairs."""
+        recs = []
+        prevhashes = []
+        urlsafe = self.keys.urlsafe
+        plan = self.plan
+        source_index = plan.columns[self.source_id]
+        for offset, values in rows:
+            try:
+                reckey = urlsafe(values[source_index].lower())
+                if self.prevversions:
+                    row = plan.row(values)
+                    for version in self.prevversions:
+                        prevhashes.append((reckey, version, rechash.rechash(row, version)))
+                if self.two_phase:
+                    recjson = None # Built later by ChangedRecords if needed.
+                else:
+                    recjson = self.recjson(values)
+                rawhash = plan.rawhash(values)
+                hash, fieldhashes = plan.rechash_fields(values)
+                recs.append((reckey, hash, recjson, offset, rawhash, fieldhashes))
+            except Exception as (strerror):
+                logging.error('Unable to process row at byte %s - %s' % (offset, strerror))
+        return recs, prevhashes
+
+def process_range(processor, csvfile, start, end, fieldnames):
+    """Parses and processes the rows of csvfile in the byte range [start, end).
+
+    Runs in TmpTable worker processes and returns (tmp rows, tmphash rows,
+    number of rows parsed, end, number of rows read with the fallback
+    encoding). The decoder is a copy, so its count does not reach the parent.
+    """
+    fallbacks = processor.decoder.fallbacks
+    f = open_csv(csvfile)
+    try:
+        rows = list(read_csv_range(f, start, end, fieldnames, values=True,
+                                   decode=processor.decoder, skipinitialspace=True))
+    finally:
+        f.close()
+    recs, prevhashes = processor(rows)
+    return recs, prevhashes, len(rows), end, processor.decoder.fallbacks - fallbacks
+
 class DeltaProcessor(object):
 
-    DB_FILE = 'bulk.sqlite3.db'
+    DB_FILE = partitions.DB_FILE
     CACHE_TABLE = 'cache'
     TMP_TABLE = 'tmp'
 
     class TmpTable(object):
 
-        def __init__(self, conn, options, table):
+        def __init__(self, conn, options, table, codec=None):
             self.conn = conn
             self.options = options
             self.table = table
-            self.insertsql = 'insert into tmp values (?, ?, ?)'
-                
-        def _get_rec(self, row):
-            rec = {}
-            for name,value in row.iteritems():
-                full_name = concepts.get_full_name(name)
-                if not full_name: # Skip non-dwc names
-                    continue
-                typed_value = concepts.transform(full_name, value)
-                if typed_value: 
-                    value = typed_value
+            self.workers = getattr(options, 'workers', 1) or 1
+            self.resume = getattr(options, 'resume', False)
+            self.chunked = getattr(options, 'chunked', False)
+            self.drop_duplicates = getattr(options, 'drop_duplicates', False)
+            # Reckeys read so far, to find repeated source_ids:
+            self.seen = DigestSet()
+            self.duplicates = 0
+            self.insertsql = 'insert or replace into tmp values (?, ?, ?, ?, ?, ?, ?)'
+            self.hashsql = 'insert or replace into tmphash values (?, ?, ?)'
+            self.checkpointsql = 'insert or replace into checkpoint values (1, ?, ?, ?, ?, ?)'
+            self.copysql = 'insert or replace into tmp select reckey, rechash, recjson, NULL, rawhash, fieldhashes, recchunk from cache where recchunk = ?'
+            self.chunksql = 'insert or replace into tmpchunks values (?, ? + coalesce((select rowcount from tmpchunks where digest = ?), 0))'
+            # Older hash versions still in the cache, see RehashedRecords:
+            prevversions = [x[0] for x in conn.execute(
+                    'select distinct hashversion from cache where hashversion <> ?',
+                    (rechash.CURRENT_VERSION,))]
+            self.processor = RowProcessor(options, prevversions, codec)
+
+        def _duplicate(self, offset):
+            self.duplicates += 1
+            if self.duplicates <= DUPLICATES_LOGGED:
+                row = 'row at byte %s' % offset if offset is not None else 'row of an unchanged chunk'
+                logging.warning('The source_id of the %s was already read%s' % (
+                        row, ', dropping it' if self.drop_duplicates else ''))
+
+        def _dedupe(self, recs, prevhashes):
+            """Returns (recs, prevhashes) without the rows whose reckey was
+            read before when dropping duplicates, as is otherwise, after
+            reporting the duplicates.
+
+            Without dropping, a repeated reckey replaces the earlier row in tmp,
+            so the last row of a source_id wins. Dropping keeps the first.
+            """
+            kept = []
+            add = self.seen.add
+            for rec in recs:
+                if add(rec[0]):
+                    kept.append(rec)
                 else:
-                    pass # TODO: Candidate for validation?
-                rec[full_name] = value
-            return rec
-
-        def _rowgenerator(self, rows):
-            count = 0
-            pkey = model.Key('Publisher', self.options.publisher_name)
-            ckey = model.Key('Collection', self.options.collection_name, parent=pkey)            
-            source_id = self.options.source_id
-            for row in rows:
-                count += 1
-                try:
-                    reckey = model.Key('Record', row[source_id].lower(), parent=ckey).urlsafe()
-                    cols = row.keys()
-                    cols.sort()
-                    fields = [row[x].strip() for x in cols]
-                    line = reduce(lambda x,y: '%s%s' % (unicode(x), unicode(y)), fields)
-                    rechash = hashlib.sha224(line.encode('utf-8')).hexdigest()
-                    recjson = simplejson.dumps(self._get_rec(row))
-                    yield (reckey, rechash, recjson)
-                except Exception as (strerror):
-                    logging.error('Unable to process row %s - %s' % (count, strerror))
-
-        def _insertchunk(self, rows, cursor):
+                    self._duplicate(rec[3])
+            if not self.drop_duplicates or len(kept) == len(recs):
+                return recs, prevhashes
+            # The first hashes of each version belong to the first row of a reckey:
+            keys = set(rec[0] for rec in kept)
+            hashes = []
+            versions = set()
+            for reckey, version, hash in prevhashes:
+                if reckey in keys and (reckey, version) not in versions:
+                    versions.add((reckey, version))
+                    hashes.append((reckey, version, hash))
+            return kept, hashes
+
+        def _insertchunk(self, recs, prevhashes, cursor, end, chunk=None):
+            """Writes a chunk of rows ending at byte offset end, along with the
+            checkpoint, in one savepoint."""
+            rowcount = len(recs)
+            recs, prevhashes = self._dedupe(recs, prevhashes)
+            recchunk = sqlite3.Binary(chunk) if chunk else None
+            self.writer.savepoint()
             try:
-                cursor.executemany(self.insertsql, self._rowgenerator(rows))
-                self.conn.commit()
+                cursor.executemany(self.insertsql, [rec + (recchunk,) for rec in recs])
+                if chunk:
+                    # Rows read, duplicates included, see _chunks:
+                    cursor.execute(self.chunksql, (recchunk, rowcount, recchunk))
+                cursor.executemany(self.hashsql, prevhashes)
+                cursor.execute(self.checkpointsql, self.fileinfo + (end, self.totalcount))
+                self.writer.release(len(recs), recs and end - recs[0][3])
                 logging.info('%s...' % self.totalcount)
             except Exception as e:
+                self.writer.rollback()
                 logging.error(e)
 
+        def _copychunk(self, cursor, chunk, end):
+            """Copies the cache rows of an unchanged chunk ending at byte offset
+            end to tmp, along with the checkpoint, in one savepoint."""
+            self.writer.savepoint()
+            cursor.execute(self.copysql, (sqlite3.Binary(chunk),))
+            rowcount = cursor.rowcount
+            self.totalcount += rowcount
+            cursor.execute(self.chunksql, (sqlite3.Binary(chunk), rowcount, sqlite3.Binary(chunk)))
+            # Copied rows can only be reported, not dropped:
+            for (reckey,) in self.conn.execute(
+                'select reckey from cache where recchunk = ?', (sqlite3.Binary(chunk),)):
+                if not self.seen.add(reckey):
+                    self._duplicate(None)
+            cursor.execute(self.checkpointsql, self.fileinfo + (end, self.totalcount))
+            self.writer.release(rowcount)
+            logging.info('%s...' % self.totalcount)
+
+        def _batches(self, reader, end=None):
+            """Generator for (rows, end) where rows is a list of at most
+            writer.size (offset, values) pairs and end the offset after them.
+            Rows starting at or after end, if given, are not read."""
+            rows = []
+            while end is None or reader.lines.offset < end:
+                try:
+                    values = reader.nextvalues()
+                except StopIteration:
+                    break
+                rows.append((reader.offset, values))
+                if len(rows) >= self.writer.size:
+                    yield rows, reader.lines.offset
+                    rows = []
+            if len(rows) > 0:
+                yield rows, reader.lines.offset
+
+        def _restore(self):
+            """Returns (offset, row count) of the checkpoint left in tmp by a
+            previous run on the same, unmodified, CSV file, or None."""
+            row = self.conn.execute(
+                'select csv_file, csv_size, csv_mtime, recoffset, rowcount from checkpoint').fetchone()
+            if row and tuple(row[:3]) == self.fileinfo:
+                return row[3], row[4]
+            return None
+
+        def _chunks(self, f, fieldnames):
+            """Returns (start, end, digest, unchanged) for the content-defined
+            chunks of f.
+
+            Digests also cover everything else that shapes the rows of a chunk,
+            so a chunk is unchanged only if it was read by the last chunked run
+            of the same collection, source_id, fallback encoding, header and
+            hash version. It must also still own a cache row for each of its
+            rows: a repeated source_id belongs to the chunk of its last row
+            only, so the other chunks of that source_id are parsed again.
+            """
+            salt = u'|'.join([unicode(rechash.CURRENT_VERSION), self.options.publisher_name,
+                              self.options.collection_name, self.options.source_id,
+                              self.processor.decoder.fallback] + fieldnames)
+            known = dict((str(digest), rowcount) for digest, rowcount in
+                         self.conn.execute('select digest, rowcount from chunks'))
+            owned = dict((str(digest), rowcount) for digest, rowcount in self.conn.execute(
+                    'select recchunk, count(*) from cache where recchunk is not null group by recchunk'))
+            chunks = [(start, end, digest, digest in known and known[digest] == owned.get(digest))
+                      for start, end, digest in chunk_csv(f, salt.encode('utf-8'), CHUNK_MASK)]
+            logging.info('%s of %s chunks unchanged' % (len([x for x in chunks if x[3]]), len(chunks)))
+            return chunks
+
+        def _insertparallel(self, tasks, cursor):
+            """Runs (function, args, end, chunk) tasks in a pool of worker
+            processes.
+
+            Each task returns the result of process_range. Results are
+            taken in submission order and handed to a single writer thread
+            through a bounded queue, so tmp ends up the same as with one worker
+            and only a few results are held in memory at a time. Tasks without
+            a function copy the unchanged chunk from the cache instead.
+            """
+            pool = multiprocessing.Pool(self.workers)
+            queue = Queue.Queue(maxsize=self.workers)
+            # Exception info of a failed write, re-raised in this thread:
+            errors = []
+
+            def write():
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        break
+                    if errors:
+                        # Keeps draining the queue so that put never blocks:
+                        continue
+                    try:
+                        result, end, chunk = item
+                        if result is None:
+                            self._copychunk(cursor, chunk, end)
+                            continue
+                        recs, prevhashes, count, end, fallbacks = result
+                        self.totalcount += count
+                        self.processor.decoder.fallbacks += fallbacks
+                        self._insertchunk(recs, prevhashes, cursor, end, chunk)
+                    except:
+                        errors.append(sys.exc_info())
+            writer = threading.Thread(target=write)
+            writer.start()
+
+            def get(entry):
+                result, end, chunk = entry
+                return (result and result.get()), end, chunk
+
+            def check():
+                if errors:
+                    type, value, traceback = errors[0]
+                    raise type, value, traceback
+
+            def put(entry):
+                check()
+                queue.put(get(entry))
+
+            pending = collections.deque()
+            try:
+                for function, args, end, chunk in tasks:
+                    if function:
+                        pending.append((pool.apply_async(function, args), end, chunk))
+                    else:
+                        pending.append((None, end, chunk))
+                    if len(pending) >= 2 * self.workers:
+                        put(pending.popleft())
+                while pending:
+                    put(pending.popleft())
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                queue.put(None)
+                writer.join()
+                pool.join()
+            check()
+
         def insert(self):
             csvfile = self.options.csv_file
             logging.info('Processing incoming records')
-            batchsize = BATCH_SIZE
-            rows = []
-            count = 0
-            self.totalcount = 0
-            chunkcount = 0
+            path = os.path.abspath(csvfile)
+            if isinstance(path, str):
+                path = path.decode('utf-8', 'replace')
+            stat = os.stat(csvfile)
+            self.fileinfo = (path, stat.st_size, stat.st_mtime)
             cursor = self.conn.cursor()
-            f = codecs.open(csvfile, encoding='utf-8', mode='r')
-            reader = UnicodeDictReader(f, skipinitialspace=True)
+
+            # Continues after the last committed chunk of an interrupted run:
+            restored = self._restore() if self.resume else None
+            if not restored:
+                if self.resume:
+                    logging.info('No checkpoint for %s, starting over' % csvfile)
+                # A new ingest clears what an interrupted one left behind:
+                for table in ['tmp', 'tmphash', 'tmpchunks', 'checkpoint']:
+                    cursor.execute('delete from %s' % table)
+                self.conn.commit()
+            resumeoffset, self.totalcount = restored or (0, 0)
+            if restored:
+                logging.info('Resuming at byte %s after %s records' % restored)
+                for (reckey,) in self.conn.execute('select reckey from tmp'):
+                    self.seen.add(reckey)
+
+            f = open_csv(csvfile)
+            reader = OffsetDictReader(f, decode=self.processor.decoder, skipinitialspace=True)
             source_id = self.options.source_id
             if source_id not in [x.lower() for x in reader.fieldnames]:
                 logging.critical('The source_id %s is required in csv file' % source_id)
                 sys.exit(1)
-            for row in reader:
-                if count >= batchsize:
-                    self.totalcount += count
-                    self._insertchunk(rows, cursor)
-                    count = 0
-                    rows = []
-                    chunkcount += 1
-                row = dict((k.lower(), v) for k,v in row.iteritems()) # lowercase all keys
-                rows.append(row)
-                count += 1
-            if count > 0:
-                self.totalcount += count
-                self._insertchunk(rows, cursor)
+            fieldnames = reader.fieldnames
+            self.processor.plan = rechash.ColumnPlan(fieldnames)
+            # Commits every CHECKPOINT_SECONDS, so that --resume has a checkpoint:
+            self.writer = BatchWriter(self.conn, 'ingest', batch_cap(self.options), CHECKPOINT_SECONDS)
+            with self.writer:
+                if self.chunked:
+                    chunks = [x for x in self._chunks(f, fieldnames) if x[1] > resumeoffset]
+                else:
+                    chunks = None
+                if self.workers > 1:
+                    # Workers parse their own ranges of the file:
+                    if chunks is None:
+                        chunks = [(start, end, None, False) for start, end in split_csv(f, RANGE_SIZE)
+                                  if end > resumeoffset]
+                    logging.info('Using %s worker processes on %s ranges' % (self.workers, len(chunks)))
+                    self._insertparallel(
+                        [(None if unchanged else process_range,
+                          (self.processor, csvfile, max(start, resumeoffset), end, fieldnames),
+                          end, digest)
+                         for start, end, digest, unchanged in chunks], cursor)
+                elif chunks is not None:
+                    for start, end, digest, unchanged in chunks:
+                        if unchanged:
+                            self._copychunk(cursor, digest, end)
+                            continue
+                        f.seek(max(start, resumeoffset))
+                        reader = OffsetDictReader(f, fieldnames=fieldnames, decode=self.processor.decoder,
+                                                  skipinitialspace=True)
+                        for rows, rowsend in self._batches(reader, end):
+                            self.totalcount += len(rows)
+                            recs, prevhashes = self.processor(rows)
+                            self._insertchunk(recs, prevhashes, cursor, rowsend, digest)
+                else:
+                    if resumeoffset:
+                        f.seek(resumeoffset)
+                        reader = OffsetDictReader(f, fieldnames=fieldnames, decode=self.processor.decoder,
+                                                  skipinitialspace=True)
+                    for rows, end in self._batches(reader):
+                        self.totalcount += len(rows)
+                        recs, prevhashes = self.processor(rows)
+                        self._insertchunk(recs, prevhashes, cursor, end)
+            f.close()
 
             logging.info('Processed %s records' % self.totalcount)
+            if self.processor.decoder.fallbacks:
+                logging.warning('%s rows are not UTF-8 and were read as %s' % (
+                        self.processor.decoder.fallbacks, self.processor.decoder.fallback))
+            if self.duplicates:
+                logging.warning('%s rows repeat the source_id of an earlier row, %s' % (
+                        self.duplicates, 'the first of each was kept' if self.drop_duplicates
+                        else 'the last of each was kept'))
+
+    class RehashedRecords(object):
+        """Migrates unchanged cache rows hashed with an older hash version.
+
+        Rows whose stored hash equals the hash of the incoming row under the
+        same older version are unchanged, so only their hash and version are
+        rewritten and their recstate is left alone.
+        """
+
+        def __init__(self, conn, options):
+            self.conn = conn
+            self.options = options
+            self.updatesql = 'update cache set rechash=?, rawhash=?, fieldhashes=?, hashversion=? where reckey=?'
+            self.deltasql = 'SELECT c.reckey, t.rechash, t.rawhash, t.fieldhashes FROM cache AS c JOIN tmphash AS h ON h.reckey = c.reckey AND h.hashversion = c.hashversion JOIN tmp AS t ON t.reckey = c.reckey WHERE c.rechash = h.rechash'
+            self.totalcount = 0
+
+        def _updatechunk(self, cursor, recs):
+            self.writer.executemany(cursor, self.updatesql, recs)
+            logging.info('%s...' % self.totalcount)
+
+        def execute(self):
+            logging.info('Checking for records hashed with an older version')
+            cursor = self.conn.cursor()
+            self.totalcount = 0
+
+            self.writer = BatchWriter(self.conn, 'rehash', batch_cap(self.options))
+            with self.writer:
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    self.totalcount += len(rows)
+                    self._updatechunk(
+                        cursor, [(hash, rawhash, fieldhashes, rechash.CURRENT_VERSION, reckey)
+                                 for reckey, hash, rawhash, fieldhashes in rows])
+
+            if self.totalcount > 0:
+                logging.info('%s unchanged records rehashed' % self.totalcount)
+
+    class ChangedRecords(object):
+        """Builds recjson for the new and updated rows of a two-phase run.
+
+        In two-phase mode TmpTable only stores the hash and byte offset of each
+        row. Rows whose hash is unseen or differs from the cache are re-read
+        from the CSV file by offset, in file order, to build their recjson.
+        """
+
+        def __init__(self, conn, options, codec=None):
+            self.conn = conn
+            self.options = options
+            self.processor = RowProcessor(options, [], codec)
+            self.updatesql = 'update tmp set recjson=? where reckey=?'
+            self.deltasql = "SELECT t.reckey, t.recoffset FROM tmp AS t LEFT OUTER JOIN cache AS c USING (reckey) WHERE t.recjson IS NULL AND (c.reckey IS NULL OR c.recstate = 'deleted' OR c.rechash <> t.rechash) ORDER BY t.recoffset"
+            self.totalcount = 0
+
+        def _updatechunk(self, cursor, recs):
+            self.writer.executemany(
+                cursor, self.updatesql, recs, sum(len(recjson) for recjson, reckey in recs))
+            logging.info('%s...' % self.totalcount)
+
+        def execute(self):
+            logging.info('Building records for changed rows')
+            cursor = self.conn.cursor()
+            f = open_csv(self.options.csv_file)
+            reader = OffsetDictReader(f, decode=self.processor.decoder, skipinitialspace=True)
+            self.processor.plan = rechash.ColumnPlan(reader.fieldnames)
+            self.totalcount = 0
+
+            self.writer = BatchWriter(self.conn, 'changed', batch_cap(self.options))
+            with self.writer:
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    recs = []
+                    for reckey, offset in rows:
+                        values = reader.values_at(offset)
+                        recjson = self.processor.recjson(values)
+                        recs.append((recjson, reckey))
+                    self.totalcount += len(recs)
+                    self._updatechunk(cursor, recs)
+            f.close()
+
+            logging.info('Built %s changed records' % self.totalcount)
 
     class NewRecords(object):
 
         def __init__(self, conn, options):
             self.conn = conn
             self.options = options
-            self.insertsql = 'insert into cache values (?, ?, ?, ?)' 
-            self.deltasql = "SELECT * FROM tmp LEFT OUTER JOIN cache USING (reckey) WHERE cache.reckey is null"
-            self.deltasql_deleted = "SELECT * FROM tmp LEFT OUTER JOIN cache USING (reckey) WHERE cache.reckey is not null and cache.recstate = 'deleted'"
+            self.insertsql = 'insert into cache (reckey, rechash, recjson, rawhash, fieldhashes, recstate, hashversion) values (?, ?, ?, ?, ?, ?, %d)' % rechash.CURRENT_VERSION
+            self.updatesql = 'update cache set rechash=?, recjson=?, rawhash=?, fieldhashes=?, recfields=NULL, recstate=?, hashversion=%d where reckey=?' % rechash.CURRENT_VERSION
+            self.deltasql = "SELECT reckey, tmp.rechash, tmp.recjson, tmp.rawhash, tmp.fieldhashes FROM tmp LEFT OUTER JOIN cache USING (reckey) WHERE cache.reckey is null"
+            self.deltasql_deleted = "SELECT reckey, tmp.rechash, tmp.recjson, tmp.rawhash, tmp.fieldhashes FROM tmp LEFT OUTER JOIN cache USING (reckey) WHERE cache.reckey is not null and cache.recstate = 'deleted'"
             self.totalcount = 0
-            f = codecs.open(self.options.csv_file, encoding='utf-8', mode='r')
-            reader = UnicodeDictReader(f, skipinitialspace=True)
-            columns = [x.lower() for x in reader.next().keys()]            
 
         def _insertchunk(self, cursor, recs):
-            cursor.executemany(self.insertsql, recs)
-            self.conn.commit()
+            self.writer.executemany(cursor, self.insertsql, recs)
             logging.info('%s...' % self.totalcount)
 
         def _insertchunk_update(self, cursor, recs):
-            cursor.executemany('update cache set rechash=?, recjson=? , recstate=? where reckey=?', recs)
-            self.conn.commit()
+            self.writer.executemany(cursor, self.updatesql, recs)
             logging.info('%s...' % self.totalcount)
 
         def execute(self):
             logging.info("Checking for new records")
-            batchsize = BATCH_SIZE
             cursor = self.conn.cursor()
-            newrecs = cursor.execute(self.deltasql)
-            recs = []
-            count = 0
             self.totalcount = 0
 
-            for row in newrecs.fetchall():
-                if count >= batchsize:
-                    self.totalcount += count
-                    self._insertchunk(cursor, recs)
-                    count = 0
-                    recs = []
-                count += 1
-                reckey = row[0]
-                rechash = row[1]
-                recjson = row[2]
-                recs.append((reckey, rechash, recjson, 'new'))
-            if count > 0:
-                self.totalcount += count
-                self._insertchunk(cursor, recs)
-
-            count = 0
-
-            # Handles deleted records in cache table:
-            newrecs = cursor.execute(self.deltasql_deleted)
-            for row in newrecs.fetchall():
-                if count >= batchsize:
-                    self.totalcount += count
-                    self._insertchunk_update(cursor, recs)
-                    count = 0
-                    recs = []
-                count += 1
-                reckey = row[0]
-                rechash = row[1]
-                recjson = row[2]
-                recs.append((rechash, recjson, 'new', reckey))            
-            if count > 0:
-                self.totalcount += count
-                self._insertchunk_update(cursor, recs)
-
-            self.conn.commit()
+            self.writer = BatchWriter(self.conn, 'new', batch_cap(self.options))
+            with self.writer:
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    self.totalcount += len(rows)
+                    self._insertchunk(
+                        cursor, [(reckey, hash, recjson, rawhash, fieldhashes, 'new')
+                                 for reckey, hash, recjson, rawhash, fieldhashes in rows])
+
+                # Handles deleted records in cache table:
+                for rows in staged_batches(self.conn, self.deltasql_deleted, self.writer):
+                    self.totalcount += len(rows)
+                    self._insertchunk_update(
+                        cursor, [(hash, recjson, rawhash, fieldhashes, 'new', reckey)
+                                 for reckey, hash, recjson, rawhash, fieldhashes in rows])
+
             if self.totalcount > 0:
                 logging.info('%s new records found' % self.totalcount)
             else:
                 logging.info('No new records found')
-    
+
     class UpdatedRecords(object):
         def __init__(self, conn, options):
             self.conn = conn
             self.options = options
-            self.updatesql = 'update cache set rechash=?, recjson=?, recstate=? where reckey=?'
-            self.deltasql = 'SELECT c.reckey, t.rechash, t.recjson FROM tmp as t, cache as c WHERE t.reckey = c.reckey AND t.rechash <> c.rechash'        
-            f = codecs.open(self.options.csv_file, encoding='utf-8', mode='r')
-            reader = UnicodeDictReader(f, skipinitialspace=True)
-            columns = [x.lower() for x in reader.next().keys()]            
+            self.updatesql = 'update cache set rechash=?, recjson=?, rawhash=?, fieldhashes=?, recfields=?, recstate=?, hashversion=%d where reckey=?' % rechash.CURRENT_VERSION
+            self.deltasql = 'SELECT c.reckey, t.rechash, t.recjson, t.rawhash, t.fieldhashes, c.recstate, c.recfields, c.fieldhashes FROM tmp as t, cache as c WHERE t.reckey = c.reckey AND t.rechash <> c.rechash'
+            # Rows whose raw columns changed but whose normalized record did not:
+            self.rawupdatesql = 'update cache set rawhash=? where reckey=?'
+            self.spurioussql = 'SELECT c.reckey, t.rawhash, c.rawhash IS NOT NULL FROM tmp as t, cache as c WHERE t.reckey = c.reckey AND t.rechash = c.rechash AND (c.rawhash IS NULL OR t.rawhash <> c.rawhash)'
+            self.spuriouscount = 0
 
         def _updatechunk(self, cursor, recs):
-            """Bulk inserts docs to couchdb and updates cache table doc revision."""
-            cursor.executemany(self.updatesql, recs)
-            self.conn.commit()
+            self.writer.executemany(cursor, self.updatesql, recs)
             logging.info('%s...' % self.totalcount)
 
         def execute(self):
             logging.info("Checking for updated records")
-            batchsize = BATCH_SIZE
             cursor = self.conn.cursor()
-            updatedrecs = cursor.execute(self.deltasql)
-            recs = []
-            count = 0
             self.totalcount = 0
 
-            for row in updatedrecs.fetchall():
-                if count >= batchsize:
-                    self._updatechunk(cursor, recs, entities)
-                    self.totalcount += count
-                    count = 0
-                    recs = []
-                count += 1
-                reckey = row[0]
-                rechash = row[1] # Note: This is the new hash from tmp table.
-                recjson = row[2]
-                recs.append((rechash, recjson, 'updated', reckey))
+            self.writer = BatchWriter(self.conn, 'updated', batch_cap(self.options))
+            with self.writer:
+                # Note: rechash is the new hash from tmp table.
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    self.totalcount += len(rows)
+                    self._updatechunk(
+                        cursor, [(hash, recjson, rawhash, fieldhashes,
+                                  update_fields(state, recfields, oldhashes, fieldhashes),
+                                  'updated', reckey)
+                                 for reckey, hash, recjson, rawhash, fieldhashes,
+                                 state, recfields, oldhashes in rows])
 
-            if count > 0:
-                self.totalcount += count
-                self._updatechunk(cursor, recs)
+                # Keeps the raw hash current without changing recstate:
+                self.spuriouscount = 0
+                for rows in staged_batches(self.conn, self.spurioussql, self.writer):
+                    self.spuriouscount += len([x for x in rows if x[2]])
+                    self.writer.executemany(
+                        cursor, self.rawupdatesql, [(rawhash, reckey) for reckey, rawhash, known in rows])
 
-            self.conn.commit()
             if self.totalcount > 0:
                 logging.info('%s updated records found' % self.totalcount)
             else:
                 logging.info('No updated records found')
+            if self.spuriouscount > 0:
+                logging.info('%s spurious updates avoided' % self.spuriouscount)
 
     class DeletedRecords(object):
         def __init__(self, conn, options):
             self.conn = conn
             self.options = options
-            self.deletesql = 'delete from cache where reckey=?'
             self.updatesql = 'update cache set recstate=? where reckey=?'
-            self.deltasql = 'SELECT * FROM cache LEFT OUTER JOIN tmp USING (reckey) WHERE tmp.reckey is null'
+            self.deltasql = 'SELECT reckey FROM cache LEFT OUTER JOIN tmp USING (reckey) WHERE tmp.reckey is null'
 
         def _deletechunk(self, cursor, recs):
-            cursor.executemany(self.updatesql, recs)
-            self.conn.commit()
+            self.writer.executemany(cursor, self.updatesql, recs)
             logging.info('%s...' % self.totalcount)
 
         def execute(self):
             logging.info("Checking for deleted records")
-            batchsize = BATCH_SIZE
             cursor = self.conn.cursor()
-            deletes = cursor.execute(self.deltasql)
-            count = 0
             self.totalcount = 0
-            recs = []
 
-            for row in deletes.fetchall():
-                if count >= batchsize:
-                    self._deletechunk(cursor, recs)
-                    self.totalcount += count
-                    count = 0
-                    recs = []
-                count += 1
-                reckey = row[0]
-                recs.append(('deleted', reckey))
-
-            if count > 0:
-                self.totalcount += count
-                self._deletechunk(cursor, recs)
+            self.writer = BatchWriter(self.conn, 'deleted', batch_cap(self.options))
+            with self.writer:
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    self.totalcount += len(rows)
+                    self._deletechunk(cursor, [('deleted', row[0]) for row in rows])
 
-            self.conn.commit()
             if self.totalcount > 0:
                 logging.info('%s deleted records found' % self.totalcount)
             else:
                 logging.info('No deleted records found')
 
-    class Report(object):
+    class ChunkedRecords(object):
+        """Records the chunk each cache row was read from and the chunks of
+        this run, so the next chunked run can copy unchanged chunks to tmp
+        from the cache instead of parsing them."""
+
         def __init__(self, conn, options):
             self.conn = conn
             self.options = options
-            columns = ['recstate', 'reckey', 'rechash', 'recjson']
-            f = codecs.open('report.csv', encoding='utf-8', mode='w')
-            self.writer = UnicodeDictWriter(f, columns, quoting=csv.QUOTE_MINIMAL)
-            self.writer.writeheader()
-        
+            self.updatesql = 'update cache set recchunk=? where reckey=?'
+            self.deltasql = 'SELECT t.reckey, t.recchunk FROM tmp AS t JOIN cache AS c USING (reckey) WHERE c.recchunk IS NOT t.recchunk'
+            self.totalcount = 0
+
+        def execute(self):
+            logging.info('Recording chunks')
+            cursor = self.conn.cursor()
+            self.totalcount = 0
+
+            self.writer = BatchWriter(self.conn, 'chunks', batch_cap(self.options))
+            with self.writer:
+                for rows in staged_batches(self.conn, self.deltasql, self.writer):
+                    self.totalcount += len(rows)
+                    self.writer.executemany(
+                        cursor, self.updatesql, [(recchunk, reckey) for reckey, recchunk in rows])
+
+                cursor.execute('delete from chunks')
+                cursor.execute('insert into chunks select digest, rowcount from tmpchunks')
+
+    class SortedRuns(TmpTable):
+        """A TmpTable that adds incoming rows to an ExternalSort instead of the
+        tmp table, for the sort-merge engine.
+
+        Items are (reckey, sequence, rechash, recjson, recoffset, rawhash,
+        older version hashes, field hashes), with hashes as plain strings so they can be
+        marshaled. The sequence number keeps the file order of repeated keys.
+        """
+
+        def __init__(self, conn, options, sorter, codec=None):
+            DeltaProcessor.TmpTable.__init__(self, conn, options, None, codec)
+            self.sorter = sorter
+            self.seq = 0
+            # Runs only live as long as the process, so there is nothing to resume:
+            if self.resume:
+                logging.warning('Resuming is not supported by the sortmerge engine')
+                self.resume = False
+            if self.chunked:
+                logging.warning('Chunked reading is not supported by the sortmerge engine')
+                self.chunked = False
+
+        def _insertchunk(self, recs, prevhashes, cursor, end, chunk=None):
+            recs, prevhashes = self._dedupe(recs, prevhashes)
+            prev = {}
+            for reckey, version, hash in prevhashes:
+                prev.setdefault(reckey, {})[version] = str(hash)
+            for reckey, hash, recjson, offset, rawhash, fieldhashes in recs:
+                if isinstance(recjson, buffer): # Compact
+                    recjson = str(recjson)
+                self.sorter.add((reckey, self.seq, str(hash), recjson, offset, str(rawhash),
+                                 prev.get(reckey), fieldhashes))
+                self.seq += 1
+            self.writer.resize(len(recs), recs and end - recs[0][3])
+            logging.info('%s...' % self.totalcount)
+
+    class SortMergeDeltas(object):
+        """Calculates deltas with an external merge sort instead of sqlite joins.
+
+        Incoming rows are written to sorted runs on disk and merged into one
+        stream ordered by reckey, which is compared in a single pass with the
+        cache read in reckey order on a second connection. Changes are applied
+        in batches on the first connection and leave the cache in the same
+        states as the sqlite engine.
+        """
+
+        def __init__(self, conn, options, dbfile, codec=None):
+            self.conn = conn
+            self.options = options
+            self.dbfile = dbfile
+            self.codec = codec
+            self.processor = RowProcessor(options, [], codec)
+            self.insertsql = 'insert into cache (reckey, rechash, recjson, rawhash, fieldhashes, recstate, hashversion) values (?, ?, ?, ?, ?, ?, %d)' % rechash.CURRENT_VERSION
+            self.updatesql = 'update cache set rechash=?, recjson=?, rawhash=?, fieldhashes=?, recfields=?, recstate=?, hashversion=%d where reckey=?' % rechash.CURRENT_VERSION
+            self.rehashsql = 'update cache set rechash=?, rawhash=?, fieldhashes=?, hashversion=%d where reckey=?' % rechash.CURRENT_VERSION
+            self.rawupdatesql = 'update cache set rawhash=? where reckey=?'
+            self.deletesql = 'update cache set recstate=? where reckey=?'
+            self.previoussql = 'select reckey, rechash, rawhash, recstate, hashversion, recfields, fieldhashes from cache order by reckey'
+            self.counts = dict(new=0, updated=0, deleted=0, spurious=0)
+            self.rehashcount = 0
+
+        def _incoming(self, sorter):
+            """Generator for the sorted incoming rows, keeping the last row of a
+            repeated reckey like insert or replace does in the sqlite engine."""
+            last = None
+            for item in sorter.sorted():
+                if last is not None and last[0] != item[0]:
+                    yield last
+                last = item
+            if last is not None:
+                yield last
+
+        def _previous(self):
+            """Generator for the cache rows in reckey order, read on a separate
+            connection so that WAL gives it a snapshot unaffected by writes."""
+            conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+            try:
+                for row in conn.execute(self.previoussql):
+                    yield row
+            finally:
+                conn.close()
+
+        def _merge(self, incoming, previous):
+            """Generator for (incoming row, cache row) pairs matched by reckey,
+            with None on the side where a reckey is missing."""
+            inc = next(incoming, None)
+            prev = next(previous, None)
+            while inc is not None or prev is not None:
+                if prev is None or (inc is not None and inc[0] < prev[0]):
+                    yield inc, None
+                    inc = next(incoming, None)
+                elif inc is None or prev[0] < inc[0]:
+                    yield None, prev
+                    prev = next(previous, None)
+                else:
+                    yield inc, prev
+                    inc = next(incoming, None)
+                    prev = next(previous, None)
+
+        def _applychunk(self, cursor, reader, ops):
+            inserts, updates, rehashes, rawupdates, deletes = ops
+            # Builds recjson for rows hashed in two-phase mode, in file order:
+            for rec in sorted((x for x in inserts + updates if x[2] is None),
+                              key=lambda x: x[3]):
+                values = reader.values_at(rec[3])
+                rec[2] = self.processor.recjson(values)
+            if self.codec:
+                # Compact records come out of the sorted runs as strings:
+                for rec in inserts + updates:
+                    rec[2] = sqlite3.Binary(rec[2])
+            cursor.executemany(
+                self.insertsql, [(reckey, sqlite3.Binary(hash), recjson, sqlite3.Binary(rawhash),
+                                  fieldhashes, 'new')
+                                 for reckey, hash, recjson, offset, rawhash, fieldhashes in inserts])
+            cursor.executemany(
+                self.updatesql, [(sqlite3.Binary(hash), recjson, sqlite3.Binary(rawhash),
+                                  fieldhashes, recfields, state, reckey)
+                                 for reckey, hash, recjson, offset, rawhash, fieldhashes,
+                                 recfields, state in updates])
+            cursor.executemany(self.rehashsql, rehashes)
+            cursor.executemany(self.rawupdatesql, rawupdates)
+            cursor.executemany(self.deletesql, deletes)
+
+        def execute(self):
+            sorter = ExternalSort(SORT_RUN_SIZE)
+            runs = DeltaProcessor.SortedRuns(self.conn, self.options, sorter, self.codec)
+            runs.insert()
+
+            logging.info('Merging incoming records with the cache')
+            cursor = self.conn.cursor()
+            f = open_csv(self.options.csv_file)
+            reader = OffsetDictReader(f, decode=self.processor.decoder, skipinitialspace=True)
+            self.processor.plan = rechash.ColumnPlan(reader.fieldnames)
+            ops = ([], [], [], [], [])
+            inserts, updates, rehashes, rawupdates, deletes = ops
+            pending = 0
+            writer = BatchWriter(self.conn, 'merge', batch_cap(self.options))
+            try:
+                with writer:
+                    for inc, prev in self._merge(self._incoming(sorter), self._previous()):
+                        if pending >= writer.size:
+                            writer.savepoint()
+                            self._applychunk(cursor, reader, ops)
+                            writer.release(pending)
+                            for x in ops:
+                                del x[:]
+                            pending = 0
+                        pending += 1
+                        if prev is None:
+                            reckey, seq, hash, recjson, offset, rawhash, prevhashes, fieldhashes = inc
+                            inserts.append([reckey, hash, recjson, offset, rawhash, fieldhashes])
+                            self.counts['new'] += 1
+                            continue
+                        if inc is None:
+                            deletes.append(('deleted', prev[0]))
+                            self.counts['deleted'] += 1
+                            continue
+                        reckey, seq, hash, recjson, offset, rawhash, prevhashes, fieldhashes = inc
+                        chash, crawhash, cstate, cversion, crecfields, cfieldhashes = prev[1:]
+                        chash = str(chash)
+                        if cstate == 'deleted':
+                            updates.append([reckey, hash, recjson, offset, rawhash, fieldhashes, None, 'new'])
+                            self.counts['new'] += 1
+                        elif cversion != rechash.CURRENT_VERSION and prevhashes and \
+                                prevhashes.get(cversion) == chash:
+                            rehashes.append(
+                                (sqlite3.Binary(hash), sqlite3.Binary(rawhash), fieldhashes, reckey))
+                            self.rehashcount += 1
+                        elif hash != chash:
+                            recfields = update_fields(cstate, crecfields, cfieldhashes, fieldhashes)
+                            updates.append(
+                                [reckey, hash, recjson, offset, rawhash, fieldhashes, recfields, 'updated'])
+                            self.counts['updated'] += 1
+                        elif crawhash is None or str(crawhash) != rawhash:
+                            rawupdates.append((sqlite3.Binary(rawhash), reckey))
+                            if crawhash is not None:
+                                self.counts['spurious'] += 1
+                    writer.savepoint()
+                    self._applychunk(cursor, reader, ops)
+                    writer.release(pending)
+            finally:
+                f.close()
+                sorter.close()
+
+            if self.rehashcount > 0:
+                logging.info('%s unchanged records rehashed' % self.rehashcount)
+            logging.info('%(new)s new, %(updated)s updated, %(deleted)s deleted records found' % self.counts)
+            return self.counts
+
+    class Report(object):
+        """Writes cache rows to report files.
+
+        Options select the recstates exported (all by default), the format,
+        csv or ndjson, gzip compression and a size in bytes after which a new
+        numbered part file is started, so parts can be uploaded in parallel.
+        """
+
+        def __init__(self, conn, options, filename=partitions.REPORT_FILE):
+            self.conn = conn
+            self.options = options
+            states = getattr(options, 'states', None)
+            if isinstance(states, basestring):
+                states = states.split(',')
+            self.states = states
+            self.format = getattr(options, 'report_format', None) or 'csv'
+            self.gzip = getattr(options, 'gzip', False)
+            self.part_size = getattr(options, 'part_size', None)
+            root, ext = os.path.splitext(filename)
+            if self.format == 'ndjson':
+                ext = '.ndjson'
+            self.root = root
+            self.ext = ext + ('.gz' if self.gzip else '')
+            self.columns = ['recstate', 'reckey', 'rechash', 'recjson', 'recfields']
+            self.codec = records.RecordCodec.load(conn)
+            self.filenames = []
+            self.f = None
+
+        def _close(self):
+            if self.format == 'csv':
+                self.writer.flush()
+            self.f.close()
+
+        def _open(self):
+            if self.f:
+                self._close()
+            if self.part_size:
+                filename = '%s-%05d%s' % (self.root, len(self.filenames) + 1, self.ext)
+            else:
+                filename = self.root + self.ext
+            self.filenames.append(filename)
+            self.partrows = 0
+            if self.gzip:
+                self.f = gzip.open(filename, 'wb')
+            else:
+                self.f = open(filename, 'wb')
+            if self.format == 'csv':
+                self.writer = UnicodeDictWriter(self.f, self.columns, quoting=csv.QUOTE_MINIMAL,
+                                                buffer_size=UnicodeDictWriter.BUFFER_SIZE)
+                self.writer.writeheader()
+
+        def _size(self):
+            """Returns the size of the current part, with the rows still
+            buffered by the CSV writer. Compressed parts count the bytes
+            written to the file, which zlib writes in blocks."""
+            if self.gzip:
+                return self.f.fileobj.tell()
+            if self.format == 'csv':
+                return self.f.tell() + self.writer.pending()
+            return self.f.tell()
+
+        def _json(self, recjson):
+            """Returns recjson as JSON text without empty values. Records stored
+            as JSON text without empty strings are returned as they are."""
+            if isinstance(recjson, buffer):
+                return simplejson.dumps(self.codec.decode(recjson))
+            if '""' not in recjson:
+                return recjson
+            rec = simplejson.loads(recjson)
+            return simplejson.dumps(dict((k, v) for k,v in rec.iteritems() if v))
+
         def execute(self):
             logging.info('Creating report')
-            cursor = self.conn.cursor()            
-            for row in cursor.execute('select reckey, rechash, recjson, recstate from cache'):
-                recjson = simplejson.loads(row[2])
-                json = simplejson.dumps(dict((k, v) for k,v in recjson.iteritems() if v))
-                self.writer.writerow(dict(
-                        reckey=row[0],
-                        rechash=row[1],
-                        recjson=json.encode('utf-8'),
-                        recstate=row[3]))
-            logging.info('Report saved to report.csv')
+            self._open()
+            for change in DeltaProcessor.iter_cache(self.conn, self.states, decode=False):
+                # A part holds at least one row, besides the header:
+                if self.part_size and self.partrows and self._size() >= self.part_size:
+                    self._open()
+                self.partrows += 1
+                json = self._json(change.rec)
+                if self.format == 'csv':
+                    self.writer.writerow(dict(
+                            reckey=change.reckey,
+                            rechash=change.rechash,
+                            recjson=json.encode('utf-8'),
+                            recstate=change.recstate,
+                            recfields=','.join(change.recfields or ())))
+                else:
+                    self.f.write('{"recstate": %s, "reckey": %s, "rechash": %s, "recfields": %s, "rec": %s}\n' % (
+                            simplejson.dumps(change.recstate), simplejson.dumps(change.reckey),
+                            simplejson.dumps(change.rechash), simplejson.dumps(change.recfields),
+                            json.encode('utf-8')))
+            self._close()
+            logging.info('Report saved to %s' % ', '.join(self.filenames))
 
     @classmethod
-    def setupdb(cls):
-        conn = sqlite3.connect(cls.DB_FILE, check_same_thread=False)
-        c = conn.cursor()
-        # Creates the cache table:
-        c.execute('create table if not exists ' + cls.CACHE_TABLE +
-                  '(reckey text, ' +
-                  'rechash text, ' +
-                  'recjson text, ' +
-                  'recstate text)')
-        # Creates the temporary table:
-        c.execute('create table if not exists ' + cls.TMP_TABLE +
-                  '(reckey text, ' +
-                  'rechash text, ' +
-                  'recjson text)')
-        # Clears all records from the temporary table:
-        c.execute('delete from %s' % cls.TMP_TABLE)
-        c.close()
+    def setupdb(cls, dbfile=None):
+        conn = sqlite3.connect(dbfile or cls.DB_FILE, check_same_thread=False)
+        # Creates or migrates the cache and temporary tables. The temporary
+        # tables are kept for --resume until TmpTable.insert starts over:
+        schema.upgrade(conn)
         return conn
 
     def __init__(self, options):
         self.options = options
-        self.conn = DeltaProcessor.setupdb()
+        # Partitioned by publisher and collection when options has a cache_dir:
+        self.partition = partitions.get_partition(options)
+        if self.partition:
+            self.dbfile = self.partition.dbfile
+            self.report_file = self.partition.report_file
+        else:
+            self.dbfile = DeltaProcessor.DB_FILE
+            self.report_file = partitions.REPORT_FILE
+        self.conn = DeltaProcessor.setupdb(self.dbfile)
+
+    def close(self):
+        """Closes the cache and releases the partition lock."""
+        self.conn.close()
+        if self.partition:
+            self.partition.unlock()
 
     def deltas(self):
-        """Calculates deltas and stores in sqlite."""
-        self.TmpTable(self.conn, self.options, DeltaProcessor.TMP_TABLE).insert()
-        self.NewRecords(self.conn, self.options).execute()
-        self.UpdatedRecords(self.conn, self.options).execute()
-        self.DeletedRecords(self.conn, self.options).execute()
+        """Calculates deltas and stores in sqlite.
+
+        Returns a dictionary with the number of new, updated and deleted
+        records, and of spurious updates avoided by normalized hashing.
+        """
+        if getattr(self.options, 'dwca', None):
+            self._flatten()
+        sortmerge = getattr(self.options, 'engine', 'sqlite') == 'sortmerge'
+        encoding = self._encoding()
+        # Compressed files are streamed, unless rows are read out of order, and
+        # files in single byte encodings are decoded row by row:
+        if not is_bytewise(encoding) or (is_compressed(self.options.csv_file) and (
+            (getattr(self.options, 'workers', 1) or 1) > 1 or
+            (sortmerge and getattr(self.options, 'two_phase', False)))):
+            self._copyinput(encoding)
+            if not is_bytewise(encoding):
+                encoding = 'utf-8'
+        self.options.encoding = encoding
+        if sortmerge:
+            counts = self.SortMergeDeltas(
+                self.conn, self.options, self.dbfile, self._codec()).execute()
+        else:
+            counts = self._sqlitedeltas()
+        # The run is complete, so a later --resume starts over:
+        self.conn.execute('delete from checkpoint')
+        if sortmerge or not getattr(self.options, 'chunked', False):
+            # Chunks of older runs may no longer match the cache:
+            self.conn.execute('delete from chunks')
+        self.conn.commit()
+        if self.partition:
+            self.partition.register(counts)
+        return counts
+
+    def _staged(self, name, source, write):
+        """Returns the path of the file name next to the cache, written from the
+        file source by write(source, path). A resumed run keeps a file newer
+        than source, so that it reads the file its checkpoint was taken on."""
+        path = os.path.join(os.path.dirname(os.path.abspath(self.dbfile)), name)
+        if not (getattr(self.options, 'resume', False) and os.path.exists(path) and
+                os.path.getmtime(path) >= os.path.getmtime(source)):
+            write(source, path)
+        return path
+
+    def _flatten(self):
+        """Flattens the Darwin Core Archive of options.dwca into the CSV file
+        the deltas are calculated from, keyed by the core id unless options
+        has a source_id."""
+        self.options.csv_file = self._staged(dwca.FLAT_FILE, self.options.dwca, dwca.flatten)
+        if not getattr(self.options, 'source_id', None):
+            self.options.source_id = dwca.ID_COLUMN
+
+    def _encoding(self):
+        """Returns the encoding of the CSV file given by options, or detected."""
+        encoding = getattr(self.options, 'encoding', None)
+        if not encoding:
+            f = open_csv(self.options.csv_file)
+            try:
+                encoding = detect_encoding(f)
+            finally:
+                f.close()
+            logging.info('Reading %s as %s' % (self.options.csv_file, encoding))
+        return encoding
+
+    def _copyinput(self, encoding):
+        """Copies the CSV file uncompressed, and in UTF-8 if its rows cannot be
+        decoded one by one. Worker processes seek to their own ranges and
+        sort-merge two-phase runs re-read rows in key order, which compressed
+        files do not allow."""
+        def write(source, path):
+            logging.info('Copying %s to %s' % (source, path))
+            f = open_csv(source)
+            out = open(path, 'wb')
+            try:
+                if is_bytewise(encoding):
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+                else:
+                    transcode(f, encoding, out)
+            finally:
+                out.close()
+                f.close()
+        self.options.csv_file = self._staged(INPUT_FILE, self.options.csv_file, write)
+
+    def _sample(self):
+        """Returns the records of the first DICTIONARY_SAMPLE rows of the CSV file."""
+        f = open_csv(self.options.csv_file)
+        recs = []
+        processor = RowProcessor(self.options, [])
+        reader = OffsetDictReader(f, decode=processor.decoder, skipinitialspace=True)
+        processor.plan = rechash.ColumnPlan(reader.fieldnames)
+        while len(recs) < DICTIONARY_SAMPLE:
+            try:
+                values = reader.nextvalues()
+            except StopIteration:
+                break
+            recs.append(processor.get_planned_rec(values))
+        f.close()
+        return recs
+
+    def _codec(self):
+        """Returns the RecordCodec that writes compact recjson, or None to
+        write JSON text.
+
+        With compact set to dictionary, the most recent dictionary in the
+        cache is used, and one is trained on the CSV file if there is none.
+        """
+        compact = getattr(self.options, 'compact', None)
+        if not compact:
+            return None
+        codec = records.RecordCodec.load(self.conn)
+        if compact == 'dictionary':
+            codec.dictionary_id = codec.latest()
+            if codec.dictionary_id is None:
+                logging.info('Training a dictionary for compact records')
+                codec = records.RecordCodec.train(self.conn, self._sample())
+        return codec
+
+    def _sqlitedeltas(self):
+        codec = self._codec()
+        self.TmpTable(self.conn, self.options, DeltaProcessor.TMP_TABLE, codec).insert()
+        self.RehashedRecords(self.conn, self.options).execute()
+        if getattr(self.options, 'two_phase', False):
+            self.ChangedRecords(self.conn, self.options, codec).execute()
+        new = self.NewRecords(self.conn, self.options)
+        new.execute()
+        updated = self.UpdatedRecords(self.conn, self.options)
+        updated.execute()
+        deleted = self.DeletedRecords(self.conn, self.options)
+        deleted.execute()
+        if getattr(self.options, 'chunked', False):
+            self.ChunkedRecords(self.conn, self.options).execute()
+        return dict(
+            new=new.totalcount,
+            updated=updated.totalcount,
+            deleted=deleted.totalcount,
+            spurious=updated.spuriouscount)
+
+    @staticmethod
+    def iter_cache(conn, states=CHANGED_STATES, decode=True):
+        """Generator for a Change per cache row in one of states, or in any
+        state if states is None, in reckey order. With decode False, rec is
+        the recjson as stored.
+
+        Rows are paged by reckey, BATCH_SIZE at a time, so no cursor stays
+        open between pages and the caller may write to the cache, e.g. to
+        mark rows as published, while consuming changes.
+        """
+        codec = records.RecordCodec.load(conn)
+        sql = 'select reckey, rechash, recjson, recstate, recfields from cache where reckey > ?'
+        if states is not None:
+            sql += ' and recstate in (%s)' % ', '.join('?' * len(states))
+        sql += ' order by reckey limit ?'
+        lastreckey = ''
+        while True:
+            params = [lastreckey] + list(states or []) + [BATCH_SIZE]
+            rows = conn.execute(sql, params).fetchall()
+            if not rows:
+                break
+            lastreckey = rows[-1][0]
+            for reckey, hash, recjson, recstate, recfields in rows:
+                yield Change(
+                    recstate, reckey, rechash.hexdigest(hash),
+                    codec.decode(recjson) if decode else recjson,
+                    tuple(recfields.split(',')) if recfields else None)
+
+    def iter_changes(self, states=CHANGED_STATES):
+        """Generator for the changes left in the cache by deltas(), as Change
+        tuples, for consuming deltas in process instead of through report().
+
+        states selects the recstates yielded: new, updated and deleted by
+        default, or all rows if None.
+        """
+        return DeltaProcessor.iter_cache(self.conn, states)
 
     def report(self):
-        self.Report(self.conn, self.options).execute()
+        self.Report(self.conn, self.options, self.report_file).execute()
 
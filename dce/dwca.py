@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides a streaming reader of Darwin Core Archives.
+
+An archive is a zip file with a meta.xml describing a core data file and any
+number of extension files, whose rows refer to core rows by id. flatten()
+writes the archive as the single CSV file the delta calculation reads: one
+row per core row, with columns named after the local names of the terms of
+meta.xml, an id column with the core id, and the values of the extension
+rows of each core row joined with EXTENSION_SEPARATOR.
+
+Data files are read straight out of the zip file. Without extensions the
+core is copied in file order. With extensions, the core and every extension
+are sorted by core id with an ExternalSort and merge joined, so neither is
+held in memory.
+"""
+
+# DCE modules
+from utils import ExternalSort, csv_lines, decode_row
+
+# Standard Python modules
+import csv
+import logging
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+META_FILE = 'meta.xml'
+NAMESPACE = '{http://rs.tdwg.org/dwc/text/}'
+
+# Name of the flattened CSV file written next to the cache.
+FLAT_FILE = 'dwca.csv'
+
+# Name of the column holding the core id, the default source_id.
+ID_COLUMN = 'id'
+
+# Joins the values of the extension rows of a core row, as in Darwin Core lists.
+EXTENSION_SEPARATOR = u' | '
+
+# Rows sorted in memory per run when joining extensions.
+SORT_RUN_SIZE = 100 * 1000
+
+def _unescape(value):
+    """Returns a meta.xml delimiter such as \\t as the character it stands for."""
+    return value.encode('utf-8').decode('string_escape')
+
+def _local_name(term):
+    """Returns the last part of a term URI, e.g. country for
+    http://rs.tdwg.org/dwc/terms/country."""
+    return term.rstrip('/').replace('#', '/').split('/')[-1]
+
+class DataFile(object):
+    """The core or an extension file of an archive, as described in meta.xml."""
+
+    def __init__(self, element, core):
+        self.core = core
+        self.rowtype = element.get('rowType', '')
+        self.location = element.find(NAMESPACE + 'files').find(NAMESPACE + 'location').text.strip()
+        self.encoding = element.get('encoding') or 'UTF-8'
+        self.delimiter = _unescape(element.get('fieldsTerminatedBy', ','))
+        self.quotechar = _unescape(element.get('fieldsEnclosedBy', '"'))
+        self.header_lines = int(element.get('ignoreHeaderLines') or 0)
+        id_element = element.find(NAMESPACE + ('id' if core else 'coreid'))
+        self.id_index = int(id_element.get('index')) if id_element is not None else None
+        # (index or None for a constant, term, default value) of each field:
+        self.fields = []
+        for field in element.findall(NAMESPACE + 'field'):
+            index = field.get('index')
+            self.fields.append((int(index) if index is not None else None,
+                                field.get('term'), field.get('default') or u''))
+
+    def rows(self, archive):
+        """Generator for (core id, values of fields) of the rows of the file in
+        the zip file archive, with unicode values."""
+        f = archive.open(self.location)
+        lines, encoding = csv_lines(f, self.encoding)
+        kwds = dict(delimiter=self.delimiter)
+        if self.quotechar:
+            kwds['quotechar'] = self.quotechar
+        else:
+            kwds['quoting'] = csv.QUOTE_NONE
+        reader = csv.reader(lines, **kwds)
+        try:
+            for i in range(self.header_lines):
+                next(reader, None)
+            for row in reader:
+                if not row:
+                    continue
+                row = decode_row(row, encoding)
+                if row[0].startswith(u'\ufeff'): # Byte order mark
+                    row = (row[0][1:],) + row[1:]
+                values = []
+                for index, term, default in self.fields:
+                    value = row[index] if index is not None and index < len(row) else u''
+                    values.append(value or default)
+                coreid = row[self.id_index] if self.id_index is not None else None
+                yield coreid, values
+        finally:
+            f.close()
+
+class Archive(object):
+    """A Darwin Core Archive opened from a zip file."""
+
+    def __init__(self, filename):
+        self.zipfile = zipfile.ZipFile(filename)
+        if META_FILE not in self.zipfile.namelist():
+            raise ValueError('%s has no %s' % (filename, META_FILE))
+        meta = ElementTree.fromstring(self.zipfile.read(META_FILE))
+        self.core = DataFile(meta.find(NAMESPACE + 'core'), True)
+        self.extensions = [DataFile(x, False) for x in meta.findall(NAMESPACE + 'extension')]
+        if self.core.id_index is None and self.extensions:
+            raise ValueError('The core of %s has no id to join extensions on' % filename)
+
+    def close(self):
+        self.zipfile.close()
+
+    def fieldnames(self):
+        """Returns the column names of the flattened file. Terms whose local
+        name is taken by an earlier column are named by their full URI."""
+        names = [ID_COLUMN]
+        for datafile in [self.core] + self.extensions:
+            for index, term, default in datafile.fields:
+                name = _local_name(term)
+                if name.lower() in [x.lower() for x in names]:
+                    name = term
+                names.append(name)
+        return names
+
+    def _sorted(self, datafile):
+        """Returns an ExternalSort of (core id, sequence, values) for the rows
+        of datafile. The sequence keeps the file order of rows of a core id."""
+        sorter = ExternalSort(SORT_RUN_SIZE)
+        for seq, (coreid, values) in enumerate(datafile.rows(self.zipfile)):
+            sorter.add((coreid, seq, values))
+        return sorter
+
+    def rows(self):
+        """Generator for the flattened rows, lists of unicode values in the
+        order of fieldnames()."""
+        if not self.extensions:
+            for coreid, values in self.core.rows(self.zipfile):
+                yield [coreid or u''] + values
+            return
+        sorters = [self._sorted(x) for x in [self.core] + self.extensions]
+        try:
+            extensions = []
+            for datafile, sorter in zip(self.extensions, sorters[1:]):
+                extensions.append((len(datafile.fields), sorter.sorted(), [None]))
+            orphans = 0
+            for coreid, seq, values in sorters[0].sorted():
+                row = [coreid] + list(values)
+                for width, items, head in extensions:
+                    joined = [[] for i in range(width)]
+                    # Extension rows of core ids before this one have no core row:
+                    if head[0] is None:
+                        head[0] = next(items, None)
+                    while head[0] is not None and head[0][0] < coreid:
+                        orphans += 1
+                        head[0] = next(items, None)
+                    while head[0] is not None and head[0][0] == coreid:
+                        for i, value in enumerate(head[0][2]):
+                            if value:
+                                joined[i].append(value)
+                        head[0] = next(items, None)
+                    row.extend(EXTENSION_SEPARATOR.join(x) for x in joined)
+                yield row
+            for width, items, head in extensions:
+                if head[0] is not None:
+                    orphans += 1 + sum(1 for x in items)
+            if orphans:
+                logging.warning('%s extension rows refer to no core row' % orphans)
+        finally:
+            for sorter in sorters:
+                sorter.close()
+
+def flatten(filename, csvfile):
+    """Writes the Darwin Core Archive filename as the CSV file csvfile and
+    returns the number of rows written."""
+    archive = Archive(filename)
+    f = open(csvfile, 'wb')
+    try:
+        writer = csv.writer(f)
+        writer.writerow([x.encode('utf-8') for x in archive.fieldnames()])
+        count = 0
+        for row in archive.rows():
+            writer.writerow([x.encode('utf-8') for x in row])
+            count += 1
+    finally:
+        f.close()
+        archive.close()
+    logging.info('Flattened %s core rows of %s into %s' % (count, filename, csvfile))
+    return count
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides delta caches partitioned by publisher and collection.
+
+Given a cache directory, every collection gets its own cache file and report
+under <cache_dir>/<publisher>/<collection>/. Each partition is guarded by an
+exclusive lock, so delta runs on different collections can proceed in
+parallel while two runs on the same collection cannot overlap. A catalog
+database in the cache directory lists the partitions and their last run.
+"""
+
+# Standard Python modules
+import errno
+import fcntl
+import logging
+import os
+import sqlite3
+import sys
+import time
+import urllib
+
+DB_FILE = 'bulk.sqlite3.db'
+REPORT_FILE = 'report.csv'
+LOCK_FILE = 'lock'
+CATALOG_FILE = 'catalog.sqlite3.db'
+
+# Seconds to wait for another run to finish writing the catalog.
+CATALOG_TIMEOUT = 60
+
+class Partition(object):
+    """The cache files of one publisher collection."""
+
+    def __init__(self, cache_dir, publisher_name, collection_name):
+        self.cache_dir = cache_dir
+        self.publisher_name = publisher_name
+        self.collection_name = collection_name
+        # Names are quoted so that any name maps to a single directory:
+        self.path = os.path.join(
+            cache_dir, urllib.quote(publisher_name, safe=''),
+            urllib.quote(collection_name, safe=''))
+        self.dbfile = os.path.join(self.path, DB_FILE)
+        self.report_file = os.path.join(self.path, REPORT_FILE)
+        self.lockfile = None
+
+    def lock(self):
+        """Takes the partition lock, or exits if another run holds it.
+
+        The lock is an flock on a file in the partition directory, so it is
+        released by the operating system if the process dies.
+        """
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.lockfile = open(os.path.join(self.path, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.lockfile.close()
+            self.lockfile = None
+            logging.critical('Another run is using the cache of %s/%s' %
+                             (self.publisher_name, self.collection_name))
+            sys.exit(1)
+        return self
+
+    def unlock(self):
+        if self.lockfile:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+            self.lockfile.close()
+            self.lockfile = None
+
+    def register(self, counts):
+        """Records this partition and the counts of its last run in the catalog."""
+        conn = connect_catalog(self.cache_dir)
+        try:
+            conn.execute(
+                'insert or replace into partitions values (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.publisher_name, self.collection_name, self.path,
+                 time.strftime('%Y-%m-%dT%H:%M:%S'), counts['new'], counts['updated'],
+                 counts['deleted'], counts['spurious']))
+            conn.commit()
+        finally:
+            conn.close()
+
+def connect_catalog(cache_dir):
+    """Returns a connection to the catalog of cache_dir, creating it if needed."""
+    conn = sqlite3.connect(os.path.join(cache_dir, CATALOG_FILE), timeout=CATALOG_TIMEOUT)
+    conn.execute('create table if not exists partitions ('
+                 'publisher_name text, '
+                 'collection_name text, '
+                 'path text, '
+                 'lastrun text, '
+                 'new integer, '
+                 'updated integer, '
+                 'deleted integer, '
+                 'spurious integer, '
+                 'primary key (publisher_name, collection_name)) without rowid')
+    return conn
+
+def catalog(cache_dir):
+    """Returns (publisher, collection, path, last run) of every partition."""
+    conn = connect_catalog(cache_dir)
+    try:
+        return conn.execute(
+            'select publisher_name, collection_name, path, lastrun from partitions '
+            'order by publisher_name, collection_name').fetchall()
+    finally:
+        conn.close()
+
+def get_partition(options):
+    """Returns the locked Partition selected by options, or None when options
+    have no cache_dir and the single cache in the working directory is used."""
+    cache_dir = getattr(options, 'cache_dir', None)
+    if not cache_dir:
+        return None
+    return Partition(cache_dir, options.publisher_name, options.collection_name).lock()
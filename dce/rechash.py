@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides versioned record hashes for delta calculation.
+
+Every hash function takes a row dictionary of unicode names and values and
+returns the value stored in cache.rechash. The version used is stored next to
+it in cache.hashversion, so caches hashed with an older version can be
+migrated by comparing against that version instead of re-uploading.
+"""
+
+# DCE modules
+import concepts
+
+# Standard Python modules
+import copy_reg
+import hashlib
+import simplejson
+import sqlite3
+
+# Binary hashes are buffers, which cannot be pickled by default. Registering a
+# reducer lets rows carrying them be returned by worker processes.
+copy_reg.pickle(buffer, lambda b: (buffer, (str(b),)))
+
+def legacy_hash(row):
+    """Version 1: hex SHA-224 of the stripped values concatenated in column
+    name order. Field boundaries are not delimited."""
+    cols = row.keys()
+    cols.sort()
+    fields = [row[x].strip() for x in cols]
+    line = reduce(lambda x,y: '%s%s' % (unicode(x), unicode(y)), fields)
+    return hashlib.sha224(line.encode('utf-8')).hexdigest()
+
+def canonical_hash(row):
+    """Version 2: binary SHA-1 of the names and stripped values in column name
+    order, followed by the length of each of them. The lengths make the
+    serialization unambiguous, and it is built with a single join, so it is
+    linear in the size of the row."""
+    names = sorted(row.keys())
+    return _canonical(names, [row[x].strip() for x in names])
+
+def _canonical(names, values):
+    fields = names + values
+    lengths = ','.join(map(str, map(len, fields)))
+    line = u''.join(fields).encode('utf-8')
+    return sqlite3.Binary(hashlib.sha1(line + '|' + lengths).digest())
+
+def normalize(row):
+    """Returns the normalized Darwin Core record of row.
+
+    Columns that are not Darwin Core concepts are ignored, names are mapped
+    to full concept names, values have whitespace collapsed and are lowercased
+    and typed with concepts.transform, and empty values are dropped.
+    """
+    rec = {}
+    for name,value in row.iteritems():
+        full_name = concepts.get_full_name(name)
+        if not full_name: # Skip non-dwc names
+            continue
+        value = u' '.join(value.split()).lower()
+        if not value:
+            continue
+        typed_value = concepts.transform(full_name, value)
+        if typed_value:
+            value = unicode(typed_value)
+        rec[full_name] = value
+    return rec
+
+def concept_hash(row):
+    """Version 3: canonical hash of the normalized Darwin Core record. Adding a
+    non Darwin Core column or changing only case or spacing leaves it as is."""
+    return canonical_hash(normalize(row))
+
+def field_hashes(rec):
+    """Returns JSON mapping each name of a normalized record to the first 8
+    bytes of the SHA-1 of its value, in hex."""
+    return simplejson.dumps(
+        dict((name, hashlib.sha1(value.encode('utf-8')).hexdigest()[:16])
+             for name,value in rec.iteritems()), sort_keys=True)
+
+def changed_fields(old, new):
+    """Returns the sorted names whose hashes differ between two field_hashes
+    values, including names only present in one of them."""
+    old = simplejson.loads(old)
+    new = simplejson.loads(new)
+    return sorted(x for x in set(old) | set(new) if old.get(x) != new.get(x))
+
+# Hash functions by version.
+HASHES = {
+    1: legacy_hash,
+    2: canonical_hash,
+    3: concept_hash,
+}
+
+CURRENT_VERSION = 3
+
+# Version of the raw hash kept alongside, which covers every column as is. It
+# is used to count updates avoided by hashing normalized records.
+RAW_VERSION = 2
+
+def rechash(row, version=CURRENT_VERSION):
+    """Returns the hash of row computed with the given hash version."""
+    return HASHES[version](row)
+
+def rechash_fields(row):
+    """Returns (hash, field hashes) of row under the current version, with the
+    record normalized only once."""
+    rec = normalize(row)
+    return canonical_hash(rec), field_hashes(rec)
+
+class ColumnPlan(object):
+    """Hashes rows given as lists of values in the column order of a CSV
+    header, looking names up once for the header instead of for every cell.
+
+    It gives the same hashes as the functions above on row dictionaries, for
+    the raw version 2 and the current version 3, and must follow them.
+    """
+
+    def __init__(self, fieldnames):
+        self.names = [x.lower() for x in fieldnames]
+        # As in a row dictionary, the last column of a repeated name wins:
+        self.columns = dict((name, i) for i, name in enumerate(self.names))
+        self.raw = sorted(self.columns.iteritems())
+        self.rawnames = [name for name, i in self.raw]
+        # (index, full name, converter) of the Darwin Core columns, in the
+        # order of a row dictionary, which decides between columns mapping to
+        # the same concept:
+        self.concepts = []
+        for name, i in self.columns.iteritems():
+            full_name = concepts.get_full_name(name)
+            if full_name:
+                self.concepts.append((i, full_name, concepts.get_converter(full_name)))
+
+    def row(self, values):
+        """Returns the row dictionary of values, keyed by lowercase names."""
+        return dict((name, values[i]) for name, i in self.raw)
+
+    def normalize(self, values):
+        """Returns normalize() of the row of values."""
+        rec = {}
+        for i, full_name, convert in self.concepts:
+            value = u' '.join(values[i].split()).lower()
+            if not value:
+                continue
+            typed_value = convert(value) if convert else None
+            if typed_value:
+                value = unicode(typed_value)
+            rec[full_name] = value
+        return rec
+
+    def rawhash(self, values):
+        """Returns the RAW_VERSION hash of the row of values."""
+        return _canonical(self.rawnames, [values[i].strip() for name, i in self.raw])
+
+    def rechash_fields(self, values):
+        """Returns rechash_fields() of the row of values."""
+        rec = self.normalize(values)
+        return canonical_hash(rec), field_hashes(rec)
+
+def hexdigest(value):
+    """Returns a stored hash of any version as a hex string."""
+    if isinstance(value, buffer):
+        return str(value).encode('hex')
+    return value
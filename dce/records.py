@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides the compact encoding of cache.recjson.
+
+A compact record is the JSON of the record with empty values dropped and
+names replaced by their Darwin Core short names, compressed with zlib and
+stored as a blob. It can be compressed against a shared dictionary trained on
+sample records, which pays off for the many short records of a collection.
+Plain JSON text is still decoded as is, so a cache can mix both.
+"""
+
+# DCE modules
+import concepts
+
+# Standard Python modules
+import collections
+import simplejson
+import sqlite3
+import struct
+import zlib
+
+# First byte of compact records. Plain JSON records start with '{'.
+FORMAT_ZLIB = '\x01'
+FORMAT_DICTIONARY = '\x02'
+
+# Short names are only used when they map back to a single concept.
+SHORT_NAMES = dict(
+    (full, short) for full, short in concepts.FULL_TO_SHORT_NAMES.iteritems()
+    if concepts.SHORT_TO_FULL_NAMES.get(short) == full)
+FULL_NAMES = dict((short, full) for full, short in SHORT_NAMES.iteritems())
+
+# Deflate only looks 32K back, so a larger dictionary would not help.
+DICTIONARY_SIZE = 32 * 1024
+
+def _compact_json(rec):
+    return simplejson.dumps(
+        dict((SHORT_NAMES.get(name, name), value) for name,value in rec.iteritems()
+             if value is not None and value != ''), separators=(',', ':'), sort_keys=True)
+
+def train_dictionary(recs, size=DICTIONARY_SIZE):
+    """Returns a shared dictionary for records like the sample recs.
+
+    The dictionary is made of the name and value pairs seen more than once in
+    the sample, as they appear in compact JSON, with the most common last so
+    that deflate reaches them with the shortest distances.
+    """
+    counts = collections.defaultdict(int)
+    for rec in recs:
+        for fragment in _compact_json(rec)[1:-1].split('",'):
+            counts[fragment] += 1
+    fragments = []
+    total = 0
+    for count, fragment in sorted(((v, k) for k,v in counts.iteritems() if v > 1), reverse=True):
+        if total + len(fragment) + 2 > size:
+            break
+        fragments.append(fragment)
+        total += len(fragment) + 2
+    fragments.reverse()
+    return '",'.join(fragments)
+
+class RecordCodec(object):
+    """Encodes records as compact blobs and decodes any stored recjson.
+
+    A preset dictionary is emulated with copies of zlib streams that have
+    already been fed the dictionary, since zlib here has no zdict. Only the
+    bytes after the dictionary are stored. Instances can be pickled and
+    rebuild their streams on demand.
+    """
+
+    def __init__(self, dictionaries=None, dictionary_id=None, level=6):
+        """dictionaries maps ids to dictionaries for decoding, and records are
+        encoded with the one of dictionary_id, or plain zlib if None."""
+        self.dictionaries = dictionaries or {}
+        self.dictionary_id = dictionary_id
+        self.level = level
+        self._streams = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_streams'] = {}
+        return state
+
+    @classmethod
+    def load(cls, conn, dictionary_id=None):
+        """Returns a codec with the dictionaries stored in the cache."""
+        dictionaries = dict((x[0], str(x[1])) for x in conn.execute('select id, data from dictionaries'))
+        return cls(dictionaries, dictionary_id)
+
+    @classmethod
+    def train(cls, conn, recs):
+        """Returns a codec encoding with a new dictionary trained on the sample
+        recs, which is stored in the cache."""
+        cursor = conn.cursor()
+        cursor.execute('insert into dictionaries (data) values (?)',
+                       (sqlite3.Binary(train_dictionary(recs)),))
+        conn.commit()
+        return cls.load(conn, cursor.lastrowid)
+
+    def latest(self):
+        """Returns the id of the most recent dictionary, or None."""
+        return max(self.dictionaries.keys()) if self.dictionaries else None
+
+    def _stream(self, dictionary_id):
+        """Returns (compressor, decompressor) primed with a dictionary."""
+        if dictionary_id not in self._streams:
+            data = self.dictionaries[dictionary_id]
+            compressor = zlib.compressobj(self.level)
+            prefix = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            decompressor = zlib.decompressobj()
+            decompressor.decompress(prefix)
+            self._streams[dictionary_id] = (compressor, decompressor)
+        return self._streams[dictionary_id]
+
+    def encode(self, rec):
+        """Returns the compact blob of the record dictionary rec."""
+        data = _compact_json(rec)
+        if self.dictionary_id is None:
+            return sqlite3.Binary(FORMAT_ZLIB + zlib.compress(data, self.level))
+        compressor = self._stream(self.dictionary_id)[0].copy()
+        return sqlite3.Binary(
+            FORMAT_DICTIONARY + struct.pack('>I', self.dictionary_id) +
+            compressor.compress(data) + compressor.flush())
+
+    def decode(self, value):
+        """Returns the record dictionary of a stored recjson, compact or not."""
+        if isinstance(value, buffer):
+            value = str(value)
+        if value[:1] == FORMAT_ZLIB:
+            data = zlib.decompress(value[1:])
+        elif value[:1] == FORMAT_DICTIONARY:
+            dictionary_id = struct.unpack('>I', value[1:5])[0]
+            decompressor = self._stream(dictionary_id)[1].copy()
+            data = decompressor.decompress(value[5:]) + decompressor.flush()
+        else:
+            return simplejson.loads(value)
+        rec = simplejson.loads(data)
+        return dict((FULL_NAMES.get(name, name), value) for name,value in rec.iteritems())
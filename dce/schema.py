@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""This module provides the versioned sqlite schema for the delta cache.
+
+The schema version is kept in the database's user_version pragma. Opening a
+cache file runs every migration newer than that version, in order and inside
+a single transaction, so existing cache files are upgraded in place.
+"""
+
+# Standard Python modules
+import logging
+
+# Pragmas applied to every connection. WAL lets readers and the writer work
+# concurrently, and NORMAL synchronous is safe in WAL mode while avoiding an
+# fsync on every commit.
+PRAGMAS = [
+    'pragma journal_mode=wal',
+    'pragma synchronous=normal',
+    'pragma cache_size=-16000',
+    'pragma temp_store=file',
+]
+
+def _has_table(cursor, name):
+    sql = "select count(*) from sqlite_master where type='table' and name=?"
+    return cursor.execute(sql, (name,)).fetchone()[0] > 0
+
+def _migrate_1(cursor):
+    """Adds primary keys on reckey and an index on unpublished recstates.
+
+    Caches created before versioning have no key on reckey, so duplicate
+    rows are collapsed, keeping the most recently inserted one.
+    """
+    cursor.execute('create table cache_v1 ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text, '
+                   'recstate text)')
+    if _has_table(cursor, 'cache'):
+        cursor.execute('insert or replace into cache_v1 '
+                       'select reckey, rechash, recjson, recstate '
+                       'from cache order by rowid')
+        cursor.execute('drop table cache')
+    cursor.execute('alter table cache_v1 rename to cache')
+    cursor.execute("create index cache_recstate on cache (recstate) "
+                   "where recstate <> 'published'")
+    # The tmp table only ever holds the current run, so it is just rebuilt.
+    cursor.execute('drop table if exists tmp')
+    cursor.execute('create table tmp ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text)')
+
+def _migrate_2(cursor):
+    """Adds the byte offset of each row in the CSV file to tmp."""
+    cursor.execute('drop table tmp')
+    cursor.execute('create table tmp ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text, '
+                   'recoffset integer)')
+
+def _migrate_3(cursor):
+    """Records the hash version of each cache row.
+
+    Existing rows were hashed with the legacy version 1. tmphash holds the
+    hashes of incoming rows under the older versions still in the cache.
+    """
+    cursor.execute('alter table cache add column '
+                   'hashversion integer not null default 1')
+    cursor.execute('create table tmphash ('
+                   'reckey text, '
+                   'hashversion integer, '
+                   'rechash text, '
+                   'primary key (reckey, hashversion)) without rowid')
+
+def _migrate_4(cursor):
+    """Adds the raw hash of every column next to the record hash."""
+    cursor.execute('alter table cache add column rawhash blob')
+    cursor.execute('drop table tmp')
+    cursor.execute('create table tmp ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text, '
+                   'recoffset integer, '
+                   'rawhash blob)')
+
+def _migrate_5(cursor):
+    """Adds per-field hashes and the fields changed by the last update.
+
+    Rows cached before this version have no field hashes, so their next
+    update has unknown changed fields, which means a full reindex.
+    """
+    cursor.execute('alter table cache add column fieldhashes text')
+    cursor.execute('alter table cache add column recfields text')
+    cursor.execute('drop table tmp')
+    cursor.execute('create table tmp ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text, '
+                   'recoffset integer, '
+                   'rawhash blob, '
+                   'fieldhashes text)')
+
+def _migrate_6(cursor):
+    """Adds the ingest checkpoint, a single row recording the CSV file being
+    read into tmp and the byte offset and row count of its last chunk."""
+    cursor.execute('create table checkpoint ('
+                   'id integer primary key check (id = 1), '
+                   'csv_file text, '
+                   'csv_size integer, '
+                   'csv_mtime real, '
+                   'recoffset integer, '
+                   'rowcount integer)')
+
+def _migrate_7(cursor):
+    """Adds the content-defined chunk each row was read from.
+
+    chunks holds the chunk digests of the last chunked run, and the cache rows
+    of those chunks can be copied to tmp instead of parsing them again.
+    """
+    cursor.execute('alter table cache add column recchunk blob')
+    cursor.execute('create index cache_recchunk on cache (recchunk) '
+                   'where recchunk is not null')
+    cursor.execute('create table chunks (digest blob primary key) without rowid')
+    cursor.execute('drop table tmp')
+    cursor.execute('create table tmp ('
+                   'reckey text primary key, '
+                   'rechash text, '
+                   'recjson text, '
+                   'recoffset integer, '
+                   'rawhash blob, '
+                   'fieldhashes text, '
+                   'recchunk blob)')
+
+def _migrate_8(cursor):
+    """Adds the shared dictionaries of compact records."""
+    cursor.execute('create table dictionaries ('
+                   'id integer primary key, '
+                   'data blob)')
+
+def _migrate_9(cursor):
+    """Adds the number of rows read from each chunk.
+
+    A cache row only records the last chunk its reckey was read from, so a
+    chunk with a repeated source_id has fewer cache rows than rows, and
+    copying them would miss the reckey. chunks only vouches for a chunk whose
+    row count matches its cache rows. tmpchunks counts the rows of the
+    chunks of the current run. Chunks of older runs have no count, so they
+    are dropped.
+    """
+    cursor.execute('drop table chunks')
+    cursor.execute('create table chunks ('
+                   'digest blob primary key, '
+                   'rowcount integer) without rowid')
+    cursor.execute('create table tmpchunks ('
+                   'digest blob primary key, '
+                   'rowcount integer) without rowid')
+
+# Ordered list of (version, migration function).
+MIGRATIONS = [
+    (1, _migrate_1),
+    (2, _migrate_2),
+    (3, _migrate_3),
+    (4, _migrate_4),
+    (5, _migrate_5),
+    (6, _migrate_6),
+    (7, _migrate_7),
+    (8, _migrate_8),
+    (9, _migrate_9),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_version(conn):
+    """Returns the schema version of the database behind conn."""
+    return conn.execute('pragma user_version').fetchone()[0]
+
+def upgrade(conn):
+    """Applies pragmas and any pending migrations to conn."""
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    version = get_version(conn)
+    pending = [(v, f) for v, f in MIGRATIONS if v > version]
+    if not pending:
+        return conn
+    # DDL implicitly commits under the default isolation level, so the
+    # transaction is managed by hand to keep the upgrade atomic.
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('begin immediate')
+        for v, migration in pending:
+            logging.info('Migrating cache schema to version %s' % v)
+            migration(cursor)
+        cursor.execute('pragma user_version=%d' % SCHEMA_VERSION)
+        cursor.execute('commit')
+    except:
+        cursor.execute('rollback')
+        raise
+    finally:
+        cursor.close()
+        conn.isolation_level = isolation_level
+    return conn
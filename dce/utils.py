@@ -22,11 +22,26 @@ __contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
 
 # Standard Python modules
 from abc import ABCMeta, abstractmethod, abstractproperty
+import array
+import bz2
 import codecs
 import cStringIO
 import csv
 import getpass
+import gzip
+import hashlib
+import heapq
+import itertools
 import logging
+import marshal
+import os
+import Queue
+import struct
+import sys
+import tempfile
+import threading
+import zipfile
+import zlib
 
 # Google App Engine modules
 from google.appengine.tools.appengine_rpc import HttpRpcServer
@@ -42,56 +57,686 @@ class UTF8Recoder:
     def next(self):
         return self.reader.next().encode("utf-8")
 
+# Joins the fields of a row so they can be decoded with a single call. It is
+# never part of a multibyte UTF-8 sequence, and rows containing it are decoded
+# field by field.
+FIELD_SEPARATOR = '\x1f'
+
+def decode_row(row, encoding="utf-8"):
+    """Returns the tuple of unicode values of a CSV row of byte strings.
+
+    Decoding the joined row allocates one string instead of one per field
+    before the split, which is several times faster on wide rows.
+    """
+    values = FIELD_SEPARATOR.join(row).decode(encoding).split(FIELD_SEPARATOR)
+    if len(values) != len(row):
+        return tuple([unicode(s, encoding) for s in row])
+    return tuple(values)
+
+# Encoding of the rows which are not UTF-8, unless detect_encoding finds a
+# byte cp1252 leaves undefined.
+FALLBACK_ENCODING = 'cp1252'
+
+# Bytes of a file read by detect_encoding, in SAMPLE_BLOCKS blocks spread over
+# files which can seek.
+SAMPLE_SIZE = 1024 * 1024
+SAMPLE_BLOCKS = 16
+
+class RowDecoder(object):
+    """Decodes CSV rows of byte strings like decode_row.
+
+    Rows are decoded as UTF-8 and, if they are not valid UTF-8, with a single
+    byte fallback encoding such as cp1252, so files which mix UTF-8 rows with
+    latin-1 or cp1252 rows are read in one pass. Rows the fallback cannot
+    decode either are decoded as latin-1. Text in single byte encodings
+    is almost never valid UTF-8 unless it is ASCII. Instances only hold
+    strings, so they can be pickled to worker processes.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        """encoding is UTF-8, with FALLBACK_ENCODING as the fallback, or the
+        fallback itself."""
+        if codecs.lookup(encoding).name == 'utf-8':
+            encoding = FALLBACK_ENCODING
+        if not is_bytewise(encoding):
+            raise ValueError('%s is not a single byte encoding' % encoding)
+        self.fallback = encoding
+        self.fallbacks = 0 # Rows decoded with the fallback
+
+    def __call__(self, row):
+        try:
+            return decode_row(row)
+        except UnicodeDecodeError:
+            self.fallbacks += 1
+        try:
+            return decode_row(row, self.fallback)
+        except UnicodeDecodeError:
+            # Bytes the fallback leaves undefined, such as 0x81 in cp1252:
+            return decode_row(row, 'latin-1')
+
+# UTF-8 continuation bytes.
+_CONTINUATION = ''.join(chr(x) for x in range(0x80, 0xc0))
+
+def _utf8_whole(block, trim_start):
+    """Returns block without the UTF-8 sequence its end may cut, and without
+    the continuation bytes it starts with if trim_start."""
+    if trim_start:
+        block = block[:3].lstrip(_CONTINUATION) + block[3:]
+    for i in range(1, min(4, len(block)) + 1):
+        byte = ord(block[-i])
+        if byte < 0x80:
+            break
+        if byte >= 0xc0:
+            # Lead byte of a sequence of 2, 3 or 4 bytes:
+            if i < (2 if byte < 0xe0 else 3 if byte < 0xf0 else 4):
+                block = block[:-i]
+            break
+    return block
+
+def detect_encoding(f, size=SAMPLE_SIZE):
+    """Returns the encoding of the file f, opened in binary mode, guessed from
+    about size bytes of it: utf-8 if they are valid UTF-8, utf-16 after a
+    UTF-16 byte order mark, and FALLBACK_ENCODING or latin-1 otherwise. Files
+    which can seek are sampled from blocks spread over the file, others from
+    their start. Leaves f at its start."""
+    f.seek(0)
+    try:
+        filesize = os.fstat(f.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        filesize = None
+    if filesize is None or filesize <= size:
+        blocks = [f.read(size)]
+    else:
+        blocks = []
+        blocksize = size / SAMPLE_BLOCKS
+        for i in range(SAMPLE_BLOCKS):
+            f.seek((filesize - blocksize) * i / (SAMPLE_BLOCKS - 1))
+            blocks.append(f.read(blocksize))
+    f.seek(0)
+    if blocks[0].startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    try:
+        for i, block in enumerate(blocks):
+            _utf8_whole(block, i > 0).decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        for block in blocks:
+            block.decode(FALLBACK_ENCODING)
+        return FALLBACK_ENCODING
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def transcode(f, encoding, out, blocksize=1024*1024):
+    """Writes the content of the file f, in encoding, to the file out as UTF-8,
+    a block at a time."""
+    reader = codecs.getreader(encoding)(f)
+    while True:
+        data = reader.read(blocksize)
+        if not data:
+            break
+        out.write(data.encode('utf-8'))
+
+# Extensions of the compressed CSV files read by open_csv.
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.zip')
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS
+
+def open_csv(filename):
+    """Opens a CSV file for reading in binary mode, decompressing .gz, .bz2 and
+    .zip files on the fly."""
+    if is_compressed(filename):
+        return DecompressedFile(filename)
+    return open(filename, 'rb')
+
+class DecompressedFile(object):
+    """A read-only binary file over the decompressed content of a .gz, .bz2 or
+    single-member .zip file.
+
+    A thread decompresses blocks ahead of the reader through a bounded queue,
+    so decompression overlaps with parsing; zlib and bz2 release the GIL while
+    they work. Offsets of tell and seek are offsets in the decompressed
+    content. Seeking forward decompresses and skips the bytes in between and
+    seeking backward starts again from the beginning, so reads should go
+    forward.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    # Blocks decompressed ahead of the reader.
+    QUEUE_DEPTH = 8
+
+    def __init__(self, filename):
+        self.name = filename
+        self.thread = None
+        self._start()
+
+    def _open(self):
+        extension = os.path.splitext(self.name)[1].lower()
+        if extension == '.gz':
+            return gzip.open(self.name, 'rb')
+        if extension == '.bz2':
+            return bz2.BZ2File(self.name, 'rb')
+        archive = zipfile.ZipFile(self.name)
+        members = [x for x in archive.namelist() if not x.endswith('/')]
+        if len(members) != 1:
+            raise ValueError('%s has %s files instead of one CSV file' % (self.name, len(members)))
+        return archive.open(members[0])
+
+    def _decompress(self, source, queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+        try:
+            while not stop.is_set():
+                block = source.read(self.BLOCK_SIZE)
+                put(block)
+                if not block:
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            source.close()
+
+    def _start(self):
+        self._stop()
+        self.queue = Queue.Queue(maxsize=self.QUEUE_DEPTH)
+        self.stop = threading.Event()
+        # Opened here so that errors such as a missing file are raised here:
+        source = self._open()
+        self.thread = threading.Thread(target=self._decompress, args=(source, self.queue, self.stop))
+        self.thread.daemon = True
+        self.thread.start()
+        self.buffer = ''
+        self.index = 0 # Position of the next unread byte in buffer
+        self.offset = 0 # Offset of the start of buffer
+        self.eof = False
+
+    def _stop(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def _fill(self):
+        """Appends the next decompressed block to the buffer, dropping the bytes
+        already read. Returns False at the end of the content."""
+        if self.eof:
+            return False
+        block = self.queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self.eof = True
+            return False
+        self.offset += self.index
+        self.buffer = self.buffer[self.index:] + block
+        self.index = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self.buffer) - self.index
+        while len(self.buffer) - self.index < size and self._fill():
+            pass
+        data = self.buffer[self.index:self.index + size]
+        self.index += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = self.index
+        while True:
+            end = self.buffer.find('\n', start)
+            if end != -1:
+                end += 1
+                break
+            searched = len(self.buffer) - self.index
+            if not self._fill():
+                end = len(self.buffer)
+                break
+            start = self.index + searched
+        if size is not None and size >= 0:
+            end = min(end, self.index + size)
+        line = self.buffer[self.index:end]
+        self.index = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self.offset + self.index
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise IOError('Decompressed files can only seek from the start')
+        if offset < self.offset:
+            self._start()
+        while offset > self.offset + len(self.buffer):
+            # Skips the whole buffer:
+            self.index = len(self.buffer)
+            if not self._fill():
+                break
+        self.index = max(0, min(offset - self.offset, len(self.buffer)))
+
+    def close(self):
+        self._stop()
+        self.buffer = ''
+
+# Encodings already checked by is_bytewise.
+_BYTEWISE = {}
+
+def is_bytewise(encoding):
+    """Returns True if CSV files in encoding can be parsed as bytes and decoded
+    cell by cell afterwards: UTF-8, and single byte (charmap) encodings of
+    ASCII as ASCII, where delimiters, quotes and newlines are never part of
+    another character."""
+    if encoding not in _BYTEWISE:
+        info = codecs.lookup(encoding)
+        module = sys.modules[info.incrementaldecoder.__module__]
+        ascii = ''.join(chr(i) for i in range(128))
+        _BYTEWISE[encoding] = info.name in ('utf-8', 'ascii', 'iso8859-1') or (
+            hasattr(module, 'decoding_table') and ascii.decode(encoding) == ascii.decode('ascii'))
+    return _BYTEWISE[encoding]
+
+def csv_lines(f, encoding):
+    """Returns (lines, encoding) for the csv module to read the file f in the
+    given encoding, and the encoding of the cells it returns. Files are read
+    as they are if is_bytewise(encoding), and re-encoded to UTF-8 otherwise."""
+    if is_bytewise(encoding):
+        return f, encoding
+    return UTF8Recoder(f, encoding), 'utf-8'
+
 class UnicodeDictReader:
     """A CSV reader which will iterate over lines in the CSV file "f", which is 
     encoded in the given encoding.
+
+    Lines are handed to the csv module as read and each row is decoded once,
+    unless the encoding needs re-encoding to UTF-8 first. Field names are
+    UTF-8 byte strings.
     """
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
+        f, self.encoding = csv_lines(f, encoding)
         self.reader = csv.reader(f, dialect=dialect, **kwds)
         self.fieldnames = self.reader.next()
+        if codecs.lookup(self.encoding).name != 'utf-8':
+            self.fieldnames = [x.decode(self.encoding).encode('utf-8') for x in self.fieldnames]
 
     def next(self):
         row = self.reader.next()
         if len(row) == 0:
             raise StopIteration
-        vals = [unicode(s, "utf-8") for s in row]
+        vals = decode_row(row, self.encoding)
         return dict((self.fieldnames[x], vals[x]) for x in range(len(self.fieldnames)))
 
     def __iter__(self):
         return self
 
+class LineOffsetReader:
+    """Iterator over the lines of a file opened in binary mode which tracks 
+    the byte offset of the next unread line.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+class OffsetDictReader(UnicodeDictReader):
+    """A UnicodeDictReader over a UTF-8 CSV file opened in binary mode which
+    records the byte offset where the last returned row starts, so the row can
+    be read again later with row_at(offset).
+    """
+    def __init__(self, f, dialect=csv.excel, fieldnames=None, decode=decode_row, **kwds):
+        """If fieldnames is given, f is not expected to start with a header and
+        rows are read from its current position. Rows are decoded by decode,
+        such as a RowDecoder for files which are not all UTF-8."""
+        self.f = f
+        self.dialect = dialect
+        self.kwds = kwds
+        self.decode = decode
+        self.lines = LineOffsetReader(f)
+        self.reader = csv.reader(self.lines, dialect=dialect, **kwds)
+        if fieldnames is None:
+            fieldnames = [x.encode('utf-8') for x in decode(self.reader.next())]
+        self.fieldnames = fieldnames
+        self.offset = None
+
+    def next(self):
+        vals = self.nextvalues()
+        return dict((self.fieldnames[x], vals[x]) for x in range(len(self.fieldnames)))
+
+    def nextvalues(self):
+        """Returns the next row as a tuple of unicode values in column order,
+        without building a dictionary."""
+        self.offset = self.lines.offset
+        row = self.reader.next()
+        if len(row) == 0:
+            raise StopIteration
+        return self.decode(row)
+
+    def _seek(self, offset):
+        self.f.seek(offset)
+        self.lines = LineOffsetReader(self.f)
+        self.reader = csv.reader(self.lines, dialect=self.dialect, **self.kwds)
+
+    def row_at(self, offset):
+        """Returns the row starting at byte offset, leaving the file positioned
+        after it."""
+        self._seek(offset)
+        return self.next()
+
+    def values_at(self, offset):
+        """Returns the values of the row starting at byte offset, like
+        nextvalues."""
+        self._seek(offset)
+        return self.nextvalues()
+
+def split_csv(f, size, quotechar='"', blocksize=1024*1024):
+    """Returns a list of (start, end) byte ranges of about size bytes each which
+    cover the records of the CSV file f, opened in binary mode, after its header.
+
+    Every range starts and ends on a record boundary, i.e. after a newline that
+    is outside a quoted field, so each range can be parsed on its own even when
+    quoted fields contain newlines. Quoting is tracked by the parity of the
+    quote characters read so far, which holds for doubled quotes but not for
+    dialects that escape quotes with an escapechar.
+    """
+    f.seek(0)
+    starts = []
+    pos = 0 # Offset of the current block in f
+    inquote = 0 # Quote parity at the start of the current block
+    target = 0 # Next boundary wanted at or after this offset
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        i = 0
+        while i < len(block):
+            if target > pos + i:
+                # Only the quote parity matters until the target offset.
+                j = min(target - pos, len(block))
+                inquote ^= block.count(quotechar, i, j) & 1
+                i = j
+                continue
+            nl = block.find('\n', i)
+            if nl == -1:
+                inquote ^= block.count(quotechar, i) & 1
+                break
+            inquote ^= block.count(quotechar, i, nl) & 1
+            i = nl + 1
+            if not inquote:
+                starts.append(pos + i)
+                target = pos + i + size
+        pos += len(block)
+    ends = starts[1:] + [pos]
+    return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+def read_csv_range(f, start, end, fieldnames, values=False, **kwds):
+    """Generator for (offset, row) pairs of the rows of the CSV file f, opened in
+    binary mode, that start in the byte range [start, end) as returned by 
+    split_csv. Rows are dictionaries keyed by fieldnames, or tuples of values
+    if values is True."""
+    f.seek(start)
+    reader = OffsetDictReader(f, fieldnames=fieldnames, **kwds)
+    read = reader.nextvalues if values else reader.next
+    while reader.lines.offset < end:
+        try:
+            row = read()
+        except StopIteration:
+            break
+        yield reader.offset, row
+
+def chunk_csv(f, salt='', mask=1023, maxlines=64*1024, quotechar='"'):
+    """Returns a list of (start, end, digest) content-defined chunks covering the
+    records of the CSV file f, opened in binary mode, after its header.
+
+    A chunk ends after a record whose last line has a CRC-32 with the bits of
+    mask all zero, or after maxlines lines, so boundaries only depend on the
+    nearby content and an edit leaves the other chunks unchanged. Records
+    are tracked by quote parity as in split_csv. The digest is the SHA-1 of
+    salt followed by the bytes of the chunk.
+    """
+    f.seek(0)
+    chunks = []
+    pos = 0
+    inquote = 0
+    start = None # Start of the current chunk, None while in the header
+    lines = 0
+    digest = None
+    for line in f:
+        pos += len(line)
+        inquote ^= line.count(quotechar) & 1
+        if start is None:
+            if not inquote:
+                start = pos
+                digest = hashlib.sha1(salt)
+            continue
+        digest.update(line)
+        lines += 1
+        if inquote:
+            continue
+        if zlib.crc32(line) & mask == 0 or lines >= maxlines:
+            chunks.append((start, pos, digest.digest()))
+            start = pos
+            digest = hashlib.sha1(salt)
+            lines = 0
+    if start is not None and pos > start:
+        chunks.append((start, pos, digest.digest()))
+    return chunks
+
+class DigestSet(object):
+    """A set of strings stored as 8-byte digests in an open-addressing hash
+    table backed by an array, which takes 11 to 16 bytes per string where a
+    set of the strings takes over 100.
+
+    Strings with the same digest are taken as equal, which among n strings
+    happens with a probability of about n * n / 2**65, or 1 in 15000 at 50
+    million strings.
+    """
+    # Largest fraction of slots in use before the table grows by half:
+    LOAD = 0.75
+
+    def __init__(self, capacity=1024):
+        self.table = array.array('L', [0]) * capacity
+        # Digests are as wide as the array items, 8 bytes on 64-bit platforms:
+        self.digestmask = (1 << (8 * self.table.itemsize)) - 1
+        self.count = 0
+        self.limit = int(capacity * self.LOAD)
+
+    def __len__(self):
+        return self.count
+
+    def _digest(self, s):
+        # 0 marks empty slots:
+        return (struct.unpack('<Q', hashlib.sha1(s).digest()[:8])[0] & self.digestmask) or 1
+
+    def add(self, s):
+        """Adds the string s and returns True if it was not in the set."""
+        digest = self._digest(s)
+        table = self.table
+        capacity = len(table)
+        i = digest % capacity
+        while True:
+            slot = table[i]
+            if slot == 0:
+                break
+            if slot == digest:
+                return False
+            i += 1
+            if i == capacity:
+                i = 0
+        table[i] = digest
+        self.count += 1
+        if self.count > self.limit:
+            self._grow()
+        return True
+
+    def __contains__(self, s):
+        digest = self._digest(s)
+        table = self.table
+        i = digest % len(table)
+        while table[i]:
+            if table[i] == digest:
+                return True
+            i = (i + 1) % len(table)
+        return False
+
+    def _grow(self):
+        old = self.table
+        capacity = len(old) * 3 / 2
+        table = array.array('L', [0]) * capacity
+        for digest in old:
+            if digest:
+                i = digest % capacity
+                while table[i]:
+                    i += 1
+                    if i == capacity:
+                        i = 0
+                table[i] = digest
+        self.table = table
+        self.limit = int(capacity * self.LOAD)
+
+class ExternalSort(object):
+    """Sorts more items than fit in memory.
+
+    Items are tuples of values that marshal can serialize. They are buffered
+    in memory up to runsize items, then sorted and written to a temporary run
+    file. sorted() merges the runs with a single heap merge.
+    """
+    def __init__(self, runsize=500*1000):
+        self.runsize = runsize
+        self.items = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, item):
+        self.items.append(item)
+        self.count += 1
+        if len(self.items) >= self.runsize:
+            self._flush()
+
+    def _flush(self):
+        self.items.sort()
+        run = tempfile.TemporaryFile()
+        for item in self.items:
+            marshal.dump(item, run)
+        run.seek(0)
+        self.runs.append(run)
+        self.items = []
+
+    @staticmethod
+    def _read(run):
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                break
+
+    def sorted(self):
+        """Generator for all items added so far in sorted order."""
+        self.items.sort()
+        logging.info('Merging %s sorted runs' % (len(self.runs) + 1))
+        return heapq.merge(self.items, *[self._read(run) for run in self.runs])
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.items = []
+
 class UnicodeDictWriter:
     """A CSV writer which will write rows to CSV file "f", which is encoded in 
     the given encoding.
+
+    Rows are written to f as they come. With a buffer_size, they are written
+    in blocks of about buffer_size bytes and when flush is called, so buffered
+    writers must be flushed before closing f. The output is the same either
+    way, and the header is only written along with the first row.
     """
-    def __init__(self, f, fieldnames, dialect=csv.excel, encoding="utf-8", **kwds):
+
+    # A buffer_size for callers which write many rows and flush:
+    BUFFER_SIZE = 1024 * 1024
+
+    # Rows passed to the csv module at a time by writerows.
+    ROWS_PER_CALL = 1000
+
+    def __init__(self, f, fieldnames, dialect=csv.excel, encoding="utf-8", buffer_size=0, **kwds):
         # Redirect output to a queue
         self.fieldnames = [x.encode("utf-8") for x in fieldnames]
         self.queue = cStringIO.StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
         self.encoder = codecs.getincrementalencoder(encoding)()
-        
+        # UTF-8 output is written as it is:
+        self.recode = codecs.lookup(encoding).name != 'utf-8'
+        self.buffer_size = buffer_size
+        self.started = False # Whether a row was written after the header
+
     def writeheader(self):
         self.writer.writerow(self.fieldnames)
 
     def writerow(self, row):
         self.writer.writerow([row[x].encode("utf-8") for x in self.fieldnames])
+        self.started = True
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        fieldnames = self.fieldnames
+        rows = iter(rows)
+        while True:
+            batch = [[row[x].encode("utf-8") for x in fieldnames]
+                     for row in itertools.islice(rows, self.ROWS_PER_CALL)]
+            if not batch:
+                break
+            self.writer.writerows(batch)
+            self.started = True
+            if self.queue.tell() >= self.buffer_size:
+                self.flush()
+
+    def pending(self):
+        """Returns the number of UTF-8 bytes buffered but not yet written."""
+        return self.queue.tell()
+
+    def flush(self):
+        """Writes the buffered rows to f."""
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
+        if not data or not self.started:
+            return
+        if self.recode:
+            # ... and reencode it into the target encoding
+            data = self.encoder.encode(data.decode("utf-8"))
         # write to the target stream
         self.stream.write(data)
         # empty queue
         self.queue.truncate(0)
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
 class AppEngine(object):
     """Proxy to an App Engine HttpRpcServer."""
     
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = []
+
+"""This module provides unittesting coverage for dce/batches.py."""
+
+# Fixes path for testing:
+import test_setup
+
+import logging
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from dce import batches
+
+class BatchWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbfile = tempfile.mkstemp()
+        os.close(fd)
+        self.conn = sqlite3.connect(self.dbfile)
+        self.conn.execute('create table t (a integer primary key)')
+        self.conn.commit()
+        self.time = batches.time.time
+        self.now = 0.0
+        self.next = 0
+        batches.time.time = lambda: self.now
+
+    def tearDown(self):
+        batches.time.time = self.time
+        self.conn.close()
+        os.remove(self.dbfile)
+
+    def _count(self):
+        conn = sqlite3.connect(self.dbfile)
+        count = conn.execute('select count(*) from t').fetchone()[0]
+        conn.close()
+        return count
+
+    def _batch(self, writer, seconds, nbytes=None):
+        rows = [(self.next + i,) for i in range(writer.size)]
+        self.next += writer.size
+        self.now += seconds
+        writer.executemany(self.conn.cursor(), 'insert into t values (?)', rows, nbytes)
+
+    def test_sizes_adapt_to_throughput(self):
+        writer = batches.BatchWriter(self.conn, 'test', cap=5000)
+        with writer:
+            self.assertEqual(batches.INITIAL_BATCH_SIZE, writer.size)
+            # Fast batches grow twofold at most, up to the cap:
+            self._batch(writer, 0.01)
+            self.assertEqual(2000, writer.size)
+            for i in range(3):
+                self._batch(writer, 0.01)
+            self.assertEqual(5000, writer.size)
+            # Slow batches shrink:
+            self._batch(writer, batches.TARGET_SECONDS * 4)
+            self.assertEqual(2500, writer.size)
+            # Large rows are limited by the memory budget:
+            self._batch(writer, 0.01, nbytes=batches.MEMORY_BUDGET)
+            self.assertEqual(2500, writer.size)
+            self._batch(writer, 0.01, nbytes=batches.MEMORY_BUDGET * 10)
+            self.assertEqual(250, writer.size)
+            # Nothing is committed before the phase ends:
+            self.assertEqual(0, self._count())
+        self.assertEqual(sum(writer.sizes), self._count())
+
+    def test_failed_batch_is_rolled_back(self):
+        cursor = self.conn.cursor()
+        with batches.BatchWriter(self.conn, 'test', cap=10) as writer:
+            writer.executemany(cursor, 'insert into t values (?)', [(1,), (2,)])
+            self.assertRaises(sqlite3.IntegrityError, writer.executemany,
+                              cursor, 'insert into t values (?)', [(3,), (1,)])
+            writer.executemany(cursor, 'insert into t values (?)', [(4,)])
+        self.assertEqual([(1,), (2,), (4,)], self.conn.execute('select a from t').fetchall())
+
+        # A phase that raises leaves nothing behind:
+        def phase():
+            with batches.BatchWriter(self.conn, 'test') as writer:
+                writer.executemany(cursor, 'insert into t values (?)', [(5,)])
+                raise RuntimeError('Interrupted')
+        self.assertRaises(RuntimeError, phase)
+        self.assertEqual(3, self._count())
+        self.assertEqual('', self.conn.isolation_level)
+
+    def test_checkpoints_commit(self):
+        writer = batches.BatchWriter(self.conn, 'test', cap=10, checkpoint=5)
+        with writer:
+            self._batch(writer, 1)
+            self.assertEqual(0, self._count())
+            self._batch(writer, 5)
+            self.assertEqual(20, self._count())
+            self._batch(writer, 1)
+            self.assertEqual(20, self._count())
+        self.assertEqual(30, self._count())
+
+    def test_cap(self):
+        class Options(object):
+            batch_size = None
+        self.assertEqual(batches.MAX_BATCH_SIZE, batches.batch_cap(Options()))
+        self.assertEqual(batches.MAX_BATCH_SIZE, batches.batch_cap(None))
+        Options.batch_size = 7
+        self.assertEqual(7, batches.batch_cap(Options()))
+        writer = batches.BatchWriter(self.conn, 'test', cap=7)
+        self.assertEqual(7, writer.size)
+        self.assertEqual(7, writer.floor)
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    unittest.main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = ["John Wieczorek (gtuco.btuco@gmail.com)"]
+
+"""Benchmarks for the delta pipeline.
+
+Usage: python bench.py <benchmark> [n]
+
+Each benchmark runs in a scratch directory, so the bulk.sqlite3.db in the
+current directory is never touched.
+"""
+
+# Fixes path for testing:
+import test_setup
+
+import bz2
+import codecs
+import csv
+import gzip
+import logging
+import os
+import resource
+import shutil
+import simplejson
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+
+from dce import keys
+from dce import rechash
+from dce import records
+from dce import schema
+from dce.deltas import DeltaProcessor, RowProcessor
+from dce.utils import DigestSet, OffsetDictReader, UnicodeDictReader, UnicodeDictWriter, UTF8Recoder, decode_row, open_csv
+from ndb import model
+
+DATA_CSV = os.path.join(test_setup.DIR_PATH, 'app', 'data.csv')
+
+# Peak memory growth allowed while the delta phases run, in megabytes.
+MEMORY_CEILING_MB = 64
+
+class Options(object):
+    """Stands in for the OptParser options object."""
+    def __init__(self, **opts):
+        self.__dict__.update(opts)
+
+def _maxrss_mb():
+    """Returns the peak resident set size of this process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _synthetic_cache(conn, n):
+    """Fills cache and tmp with n synthetic rows each.
+
+    Relative to cache, tmp drops the first tenth of the keys (deleted), adds
+    a tenth of unseen keys (new) and changes every third hash (updated).
+    """
+    offset = n / 10
+    recjson = '{"country": "usa", "genus": "bufo", "year": 1988}'
+    cursor = conn.cursor()
+    cursor.executemany(
+        'insert into cache (reckey, rechash, recjson, recstate) values (?, ?, ?, ?)',
+        (('k%010d' % i, 'h%d' % i, recjson, 'new') for i in xrange(n)))
+    cursor.executemany(
+        'insert into tmp (reckey, rechash, recjson) values (?, ?, ?)',
+        (('k%010d' % i, 'h%d' % (i if i % 3 else -i), recjson)
+         for i in xrange(offset, n + offset)))
+    conn.commit()
+
+def bench_deltas_memory(n):
+    """Asserts the delta phases stay under MEMORY_CEILING_MB on n rows."""
+    conn = DeltaProcessor.setupdb()
+    _synthetic_cache(conn, n)
+    before = _maxrss_mb()
+    start = time.time()
+    DeltaProcessor.NewRecords(conn, None).execute()
+    DeltaProcessor.UpdatedRecords(conn, None).execute()
+    DeltaProcessor.DeletedRecords(conn, None).execute()
+    elapsed = time.time() - start
+    growth = _maxrss_mb() - before
+    print 'deltas on %s rows: %.1fs, peak memory grew %.1f MB (ceiling %s MB)' % \
+        (n, elapsed, growth, MEMORY_CEILING_MB)
+    assert growth < MEMORY_CEILING_MB, 'Delta phases exceeded memory ceiling'
+
+def _sample_rows():
+    """Returns the rows of app/data.csv with lowercased keys."""
+    f = open(DATA_CSV, 'rb')
+    rows = [dict((k.lower(), v) for k,v in row.iteritems())
+            for row in OffsetDictReader(f, skipinitialspace=True)]
+    f.close()
+    return rows
+
+def bench_rechash(n):
+    """Times each record hash version over n rows of app/data.csv."""
+    rows = _sample_rows()
+    for version in sorted(rechash.HASHES.keys()):
+        function = rechash.HASHES[version]
+        start = time.time()
+        for i in xrange(n):
+            function(rows[i % len(rows)])
+        elapsed = time.time() - start
+        print 'rechash version %s: %s rows in %.2fs (%.0f rows/s)' % \
+            (version, n, elapsed, n / elapsed)
+
+def bench_compact(n):
+    """Compares cache size and read throughput of recjson encodings on n
+    records built from app/data.csv."""
+    recs = [RowProcessor.get_rec(row) for row in _sample_rows()]
+    for compact in [None, 'zlib', 'dictionary']:
+        dbfile = 'compact-%s.db' % compact
+        conn = sqlite3.connect(dbfile)
+        schema.upgrade(conn)
+        codec = None
+        if compact == 'dictionary':
+            codec = records.RecordCodec.train(conn, recs[:1000])
+        elif compact == 'zlib':
+            codec = records.RecordCodec()
+        encode = codec.encode if codec else simplejson.dumps
+        conn.executemany(
+            'insert into cache (reckey, recjson) values (?, ?)',
+            (('k%010d' % i, encode(recs[i % len(recs)])) for i in xrange(n)))
+        conn.commit()
+        conn.execute('vacuum')
+        # The cache is in WAL mode, so the pages are in the -wal file until then:
+        conn.execute('pragma wal_checkpoint(truncate)')
+        size = os.path.getsize(dbfile) / 1024.0 / 1024.0
+        decoder = records.RecordCodec.load(conn)
+        start = time.time()
+        for row in conn.execute('select recjson from cache'):
+            decoder.decode(row[0])
+        elapsed = time.time() - start
+        conn.close()
+        print '%s: %.2f MB for %s records, decoded %.0f records/s' % \
+            (compact or 'json', size, n, n / elapsed)
+
+def _scaled_csv(n):
+    """Writes app/data.csv repeated to n rows as scaled.csv and returns its name."""
+    f = open(DATA_CSV, 'rb')
+    header = f.readline()
+    lines = f.readlines()
+    f.close()
+    out = open('scaled.csv', 'wb')
+    out.write(header)
+    for i in xrange(n):
+        out.write(lines[i % len(lines)])
+    out.close()
+    return 'scaled.csv'
+
+def bench_plan(n):
+    """Compares reading, hashing and building the recjson of n rows of
+    app/data.csv as row dictionaries and with a column plan."""
+    csvfile = _scaled_csv(n)
+
+    f = open(csvfile, 'rb')
+    start = time.time()
+    for row in OffsetDictReader(f, skipinitialspace=True):
+        row = dict((k.lower(), v) for k,v in row.iteritems())
+        rechash.rechash(row, rechash.RAW_VERSION)
+        rechash.rechash_fields(row)
+        simplejson.dumps(RowProcessor.get_rec(row))
+    elapsed = time.time() - start
+    f.close()
+    print 'row dictionaries: %s rows in %.2fs (%.0f rows/s)' % (n, elapsed, n / elapsed)
+
+    _process(open(csvfile, 'rb'), n, 'column plan')
+
+def _process(f, n, label):
+    """Reads, hashes and builds the recjson of the rows of f with a column plan
+    and prints the throughput."""
+    start = time.time()
+    reader = OffsetDictReader(f, skipinitialspace=True)
+    plan = rechash.ColumnPlan(reader.fieldnames)
+    processor = RowProcessor(
+        Options(publisher_name='p', collection_name='c', source_id='occurrenceid'), [])
+    processor.plan = plan
+    while True:
+        try:
+            values = reader.nextvalues()
+        except StopIteration:
+            break
+        plan.rawhash(values)
+        plan.rechash_fields(values)
+        simplejson.dumps(processor.get_planned_rec(values))
+    elapsed = time.time() - start
+    f.close()
+    print '%s: %s rows in %.2fs (%.0f rows/s)' % (label, n, elapsed, n / elapsed)
+
+def bench_compressed(n):
+    """Compares processing n rows of app/data.csv read from an uncompressed
+    file and streamed from .gz, .bz2 and .zip files."""
+    csvfile = _scaled_csv(n)
+    f = gzip.open('scaled.csv.gz', 'wb')
+    shutil.copyfileobj(open(csvfile, 'rb'), f)
+    f.close()
+    f = bz2.BZ2File('scaled.csv.bz2', 'wb')
+    shutil.copyfileobj(open(csvfile, 'rb'), f)
+    f.close()
+    f = zipfile.ZipFile('scaled.zip', 'w', zipfile.ZIP_DEFLATED)
+    f.write(csvfile)
+    f.close()
+    _process(open(csvfile, 'rb'), n, 'uncompressed')
+    for name in ['scaled.csv.gz', 'scaled.csv.bz2', 'scaled.zip']:
+        _process(open_csv(name), n, name)
+
+def bench_reader(n):
+    """Compares reading n rows of app/data.csv, in UTF-8 and in cp1252, with
+    UnicodeDictReader and with the csv module fed by a UTF8Recoder as it was
+    before."""
+    csvfile = _scaled_csv(n)
+    f = open(csvfile, 'rb')
+    data = f.read().decode('utf-8')
+    f.close()
+    f = open('scaled.cp1252.csv', 'wb')
+    f.write(data.encode('cp1252', 'replace'))
+    f.close()
+    for name, encoding in [(csvfile, 'utf-8'), ('scaled.cp1252.csv', 'cp1252')]:
+        f = open(name, 'rb')
+        start = time.time()
+        reader = csv.reader(UTF8Recoder(f, encoding))
+        fieldnames = reader.next()
+        for row in reader:
+            values = decode_row(row)
+            dict((fieldnames[x], values[x]) for x in range(len(fieldnames)))
+        elapsed = time.time() - start
+        f.close()
+        print '%s recoded: %s rows in %.2fs (%.0f rows/s)' % (encoding, n, elapsed, n / elapsed)
+        f = open(name, 'rb')
+        start = time.time()
+        for row in UnicodeDictReader(f, encoding=encoding):
+            pass
+        elapsed = time.time() - start
+        f.close()
+        print '%s UnicodeDictReader: %s rows in %.2fs (%.0f rows/s)' % (
+            encoding, n, elapsed, n / elapsed)
+
+def bench_writer(n):
+    """Compares writing n report rows with UnicodeDictWriter one row at a
+    time, as before it was buffered, buffered, and with writerows."""
+    columns = ['recstate', 'reckey', 'rechash', 'recjson', 'recfields']
+    rows = [dict(recstate=u'new', reckey=u'ahR2ZXJ0bmV0LXBvcnRhbC0%s' % i,
+                 rechash=u'%040x' % i, recjson=u'{"country": "m\\u00e9xico", "year": "%s"}' % i,
+                 recfields=u'') for i in xrange(n)]
+    def unbuffered(writer):
+        # The writer before it was buffered:
+        encoder = codecs.getincrementalencoder('utf-8')()
+        for row in rows:
+            writer.writer.writerow([row[x].encode('utf-8') for x in writer.fieldnames])
+            data = writer.queue.getvalue()
+            writer.stream.write(encoder.encode(data.decode('utf-8')))
+            writer.queue.truncate(0)
+    def buffered(writer):
+        for row in rows:
+            writer.writerow(row)
+    def writerows(writer):
+        writer.writerows(rows)
+    for name, write in [('one row at a time', unbuffered), ('buffered', buffered),
+                        ('writerows', writerows)]:
+        f = open('report.csv', 'wb')
+        start = time.time()
+        writer = UnicodeDictWriter(f, columns, quoting=csv.QUOTE_MINIMAL,
+                                   buffer_size=UnicodeDictWriter.BUFFER_SIZE)
+        writer.writeheader()
+        write(writer)
+        writer.flush()
+        f.close()
+        elapsed = time.time() - start
+        print '%s: %s rows in %.2fs (%.0f rows/s)' % (name, n, elapsed, n / elapsed)
+
+def bench_keys(n):
+    """Compares building n urlsafe Record keys with ndb and with the
+    RecordKeyEncoder."""
+    names = [u'mvz:herp:%s' % i for i in xrange(n)]
+    pkey = model.Key('Publisher', 'MVZ')
+    ckey = model.Key('Collection', 'Herp', parent=pkey)
+    start = time.time()
+    for name in names:
+        model.Key('Record', name, parent=ckey).urlsafe()
+    elapsed = time.time() - start
+    print 'ndb: %s keys in %.2fs (%.0f keys/s)' % (n, elapsed, n / elapsed)
+    encoder = keys.RecordKeyEncoder('MVZ', 'Herp')
+    start = time.time()
+    for name in names:
+        encoder.urlsafe(name)
+    elapsed = time.time() - start
+    print 'encoder: %s keys in %.2fs (%.0f keys/s)' % (n, elapsed, n / elapsed)
+
+def bench_duplicates(n):
+    """Measures the memory and throughput of a DigestSet of n reckeys."""
+    encoder = keys.RecordKeyEncoder('MVZ', 'Herp')
+    before = _maxrss_mb()
+    digests = DigestSet()
+    start = time.time()
+    for i in xrange(n):
+        digests.add(encoder.urlsafe(u'mvz:herp:%s' % i))
+    elapsed = time.time() - start
+    table_mb = len(digests.table) * digests.table.itemsize / 1024.0 / 1024.0
+    print 'duplicates: %s keys in %.1fs (%.0f keys/s), table %.1f MB (%.1f bytes/key), ' \
+        'peak memory grew %.1f MB' % (n, elapsed, n / elapsed, table_mb,
+                                      table_mb * 1024 * 1024 / n, _maxrss_mb() - before)
+
+BENCHMARKS = dict(
+    compact=(bench_compact, 100 * 1000),
+    compressed=(bench_compressed, 100 * 1000),
+    deltas_memory=(bench_deltas_memory, 5 * 1000 * 1000),
+    duplicates=(bench_duplicates, 50 * 1000 * 1000),
+    keys=(bench_keys, 1000 * 1000),
+    plan=(bench_plan, 1000 * 1000),
+    reader=(bench_reader, 1000 * 1000),
+    writer=(bench_writer, 1000 * 1000),
+    rechash=(bench_rechash, 100 * 1000))
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in BENCHMARKS:
+        print 'Usage: python bench.py <benchmark> [n]'
+        print 'Benchmarks: %s' % ', '.join(sorted(BENCHMARKS.keys()))
+        sys.exit(2)
+    function, n = BENCHMARKS[argv[1]]
+    if len(argv) > 2:
+        n = int(argv[2])
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.chdir(scratch)
+    try:
+        function(n)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    main(sys.argv)
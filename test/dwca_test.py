@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = []
+
+"""This module provides unittesting coverage for dce/dwca.py."""
+
+# Fixes path for testing:
+import test_setup
+
+import csv
+import logging
+import os
+import tempfile
+import unittest
+import zipfile
+
+from dce import dwca
+
+META = """<archive xmlns="http://rs.tdwg.org/dwc/text/">
+  <core encoding="UTF-8" fieldsTerminatedBy="\\t" linesTerminatedBy="\\n"
+        fieldsEnclosedBy="" ignoreHeaderLines="1"
+        rowType="http://rs.tdwg.org/dwc/terms/Occurrence">
+    <files><location>occurrence.txt</location></files>
+    <id index="0"/>
+    <field index="1" term="http://rs.tdwg.org/dwc/terms/occurrenceID"/>
+    <field index="2" term="http://rs.tdwg.org/dwc/terms/country"/>
+    <field term="http://rs.tdwg.org/dwc/terms/basisOfRecord" default="PreservedSpecimen"/>
+  </core>
+  <extension encoding="windows-1252" fieldsTerminatedBy=","
+             rowType="http://rs.gbif.org/terms/1.0/Identification">
+    <files><location>identification.csv</location></files>
+    <coreid index="0"/>
+    <field index="1" term="http://rs.tdwg.org/dwc/terms/scientificName"/>
+    <field index="2" term="http://purl.org/dc/terms/country"/>
+  </extension>
+</archive>"""
+
+CORE = 'id\toccurrenceID\tcountry\n' \
+    '\xef\xbb\xbf2\tMVZ:2\tm\xc3\xa9xico\n' \
+    '1\tMVZ:1\t"usa\n' \
+    '3\tMVZ:3\t\n'
+
+EXTENSION = '1,Puma concolor,\n' \
+    '0,Orphan,\n' \
+    '2,"Lynx rufus, juv.",\n' \
+    '1,Felis concolor,usa\n' \
+    '2,L\xf3pez,\n'
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.zipname = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        fd, self.csvname = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.zipname)
+        os.remove(self.csvname)
+
+    def _archive(self, meta, files):
+        z = zipfile.ZipFile(self.zipname, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('meta.xml', meta)
+        for name, data in files.iteritems():
+            z.writestr(name, data)
+        z.close()
+
+    def _flatten(self):
+        count = dwca.flatten(self.zipname, self.csvname)
+        f = open(self.csvname, 'rb')
+        rows = list(csv.reader(f))
+        f.close()
+        self.assertEqual(count, len(rows) - 1)
+        return rows
+
+    def test_core(self):
+        meta = META[:META.index('<extension')] + '</archive>'
+        self._archive(meta, {'occurrence.txt': CORE})
+        self.assertEqual([
+                ['id', 'occurrenceID', 'country', 'basisOfRecord'],
+                ['2', 'MVZ:2', 'm\xc3\xa9xico', 'PreservedSpecimen'],
+                ['1', 'MVZ:1', '"usa', 'PreservedSpecimen'],
+                ['3', 'MVZ:3', '', 'PreservedSpecimen']], self._flatten())
+
+    def test_extension_join(self):
+        self._archive(META, {'occurrence.txt': CORE, 'identification.csv': EXTENSION})
+        rows = self._flatten()
+        self.assertEqual(['id', 'occurrenceID', 'country', 'basisOfRecord', 'scientificName',
+                          'http://purl.org/dc/terms/country'], rows[0])
+        self.assertEqual([
+                ['1', 'MVZ:1', '"usa', 'PreservedSpecimen', 'Puma concolor | Felis concolor', 'usa'],
+                ['2', 'MVZ:2', 'm\xc3\xa9xico', 'PreservedSpecimen',
+                 'Lynx rufus, juv. | L\xc3\xb3pez', ''],
+                ['3', 'MVZ:3', '', 'PreservedSpecimen', '', '']], rows[1:])
+
+    def test_invalid_archives(self):
+        z = zipfile.ZipFile(self.zipname, 'w')
+        z.writestr('occurrence.txt', CORE)
+        z.close()
+        self.assertRaises(ValueError, dwca.flatten, self.zipname, self.csvname)
+        self._archive(META.replace('<id index="0"/>', ''), {})
+        self.assertRaises(ValueError, dwca.flatten, self.zipname, self.csvname)
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    unittest.main()
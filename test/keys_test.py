@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = []
+
+"""This module provides unittesting coverage for dce/keys.py."""
+
+# Fixes path for testing:
+import test_setup
+
+import logging
+import os
+import random
+import unittest
+
+from dce import keys
+from google.appengine.api import namespace_manager
+from ndb import model
+
+# Characters of 1 to 4 UTF-8 bytes, and the ones base64 turns into - and _:
+ALPHABET = u'aZ09 -_./+=\xe9\xdf\u4e2d\u6587\U0001f40d\x00\x7f'
+
+class RecordKeyEncoderTest(unittest.TestCase):
+
+    def _name(self, rand, size):
+        return u''.join(rand.choice(ALPHABET) for i in range(size))
+
+    def _check(self, publisher_name, collection_name, names):
+        encoder = keys.RecordKeyEncoder(publisher_name, collection_name)
+        pkey = model.Key('Publisher', publisher_name)
+        ckey = model.Key('Collection', collection_name, parent=pkey)
+        for name in names:
+            expected = model.Key('Record', name, parent=ckey).urlsafe()
+            self.assertEqual(expected, encoder.urlsafe(name))
+            self.assertEqual(model.Key('Record', name, parent=ckey),
+                             model.Key(urlsafe=encoder.urlsafe(name)))
+
+    def test_matches_ndb(self):
+        rand = random.Random(42)
+        for i in range(50):
+            # Names up to 500 bytes make every length take one or two bytes:
+            publisher_name = self._name(rand, rand.randint(1, 120))
+            collection_name = self._name(rand, rand.randint(1, 120))
+            names = [self._name(rand, rand.randint(1, 120)) for j in range(20)]
+            names.append('x' * 500)
+            names.append('MVZ:Herp:%s' % rand.randint(0, 10 ** 6))
+            self._check(publisher_name, collection_name, names)
+
+    def test_app_and_namespace(self):
+        app_id = os.environ.get('APPLICATION_ID')
+        try:
+            # Long enough for a two byte length:
+            os.environ['APPLICATION_ID'] = 'vert-net' * 20
+            namespace_manager.set_namespace('ns')
+            self._check('MVZ', 'Birds', [u'1', u'm\xe9xico'])
+        finally:
+            namespace_manager.set_namespace('')
+            if app_id is None:
+                del os.environ['APPLICATION_ID']
+            else:
+                os.environ['APPLICATION_ID'] = app_id
+
+    def test_invalid_names(self):
+        encoder = keys.RecordKeyEncoder('MVZ', 'Birds')
+        self.assertRaises(ValueError, encoder.urlsafe, u'')
+        self.assertRaises(ValueError, encoder.urlsafe, u'\xe9' * 251)
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = []
+
+"""This module provides unittesting coverage for dce/records.py."""
+
+# Fixes path for testing:
+import test_setup
+
+import logging
+import os
+import pickle
+import simplejson
+import sqlite3
+import unittest
+
+from dce import records
+from dce import schema
+from dce.deltas import RowProcessor
+from dce.utils import OffsetDictReader
+
+DATA_CSV = os.path.join(test_setup.DIR_PATH, 'app', 'data.csv')
+
+class RecordCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        f = open(DATA_CSV, 'rb')
+        self.recs = [RowProcessor.get_rec(dict((k.lower(), v) for k,v in row.iteritems()))
+                     for row in OffsetDictReader(f, skipinitialspace=True)]
+        f.close()
+        self.conn = sqlite3.connect(':memory:')
+        schema.upgrade(self.conn)
+
+    def _nonempty(self, rec):
+        return dict((k, v) for k,v in rec.iteritems() if v != '')
+
+    def test_round_trip(self):
+        plain = records.RecordCodec()
+        trained = records.RecordCodec.train(self.conn, self.recs[:100])
+        for rec in self.recs:
+            self.assertEqual(self._nonempty(rec), plain.decode(plain.encode(rec)))
+            self.assertEqual(self._nonempty(rec), trained.decode(trained.encode(rec)))
+
+        # Any codec of the cache decodes JSON text and every dictionary:
+        codec = records.RecordCodec.load(self.conn)
+        rec = self.recs[0]
+        self.assertEqual(rec, codec.decode(simplejson.dumps(rec)))
+        self.assertEqual(self._nonempty(rec), codec.decode(trained.encode(rec)))
+        codec = pickle.loads(pickle.dumps(trained))
+        self.assertEqual(self._nonempty(rec), codec.decode(trained.encode(rec)))
+
+    def test_ambiguous_short_names(self):
+        rec = dict(institutioncode=u'MVZ', typestatus=u'holotype', country=u'usa')
+        codec = records.RecordCodec()
+        data = str(codec.encode(rec))
+        self.assertEqual(rec, codec.decode(data))
+        self.assertTrue(len(data) < len(simplejson.dumps(rec)))
+
+    def test_dictionary_is_smaller(self):
+        plain = records.RecordCodec()
+        trained = records.RecordCodec.train(self.conn, self.recs[:100])
+        size = lambda codec: sum(len(codec.encode(x)) for x in self.recs[100:])
+        json = sum(len(simplejson.dumps(x)) for x in self.recs[100:])
+        self.assertTrue(size(trained) < size(plain) < json)
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    unittest.main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Copyright 2011 The Regents of the University of California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele (eightysteele@gmail.com)"
+__copyright__ = "Copyright 2011 The Regents of the University of California"
+__contributors__ = []
+
+"""This module provides unittesting coverage for dce/utils.py."""
+
+# Fixes path for testing:
+import test_setup
+
+import bz2
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from dce import utils
+
+DATA_CSV = os.path.join(test_setup.DIR_PATH, 'app', 'data.csv')
+
+class SplitCsvTest(unittest.TestCase):
+
+    def _rows(self, f):
+        f.seek(0)
+        reader = utils.OffsetDictReader(f)
+        return reader.fieldnames, [(reader.offset, row) for row in reader]
+
+    def _ranged_rows(self, f, size):
+        f.seek(0)
+        fieldnames = utils.OffsetDictReader(f).fieldnames
+        rows = []
+        for start, end in utils.split_csv(f, size, blocksize=64):
+            rows.extend(utils.read_csv_range(f, start, end, fieldnames))
+        return rows
+
+    def test_quoted_newlines(self):
+        f = tempfile.TemporaryFile()
+        f.write('id,"recorded\nby",notes\r\n'
+                '1,"Taylor, L. C.;\npreparator: Johnston, R. F.",a\r\n'
+                '2,"Miller, ""Alden""\r\nH.",\r\n'
+                '3,"\n\n",c')
+        for size in [1, 10, 30, 1000]:
+            fieldnames, rows = self._rows(f)
+            self.assertEqual(3, len(rows))
+            self.assertEqual(rows, self._ranged_rows(f, size))
+        self.assertEqual(u'Miller, "Alden"\r\nH.', rows[1][1]['recorded\nby'])
+
+    def test_ranges_cover_file(self):
+        f = open(DATA_CSV, 'rb')
+        fieldnames, rows = self._rows(f)
+        for size in [1, 1000, 100 * 1000, 10 * 1000 * 1000]:
+            ranges = utils.split_csv(f, size)
+            self.assertEqual(rows[0][0], ranges[0][0])
+            self.assertEqual(os.path.getsize(DATA_CSV), ranges[-1][1])
+            for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, next_start)
+            self.assertEqual(rows, self._ranged_rows(f, size))
+        f.close()
+
+class DecompressedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        f = open(DATA_CSV, 'rb')
+        self.data = f.read()
+        f.close()
+        self.block_size = utils.DecompressedFile.BLOCK_SIZE
+        utils.DecompressedFile.BLOCK_SIZE = 1000
+
+    def tearDown(self):
+        utils.DecompressedFile.BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.dir)
+
+    def _compressed(self):
+        names = [os.path.join(self.dir, x) for x in ['data.csv.gz', 'data.csv.bz2', 'data.zip']]
+        f = gzip.open(names[0], 'wb')
+        f.write(self.data)
+        f.close()
+        f = bz2.BZ2File(names[1], 'wb')
+        f.write(self.data)
+        f.close()
+        f = zipfile.ZipFile(names[2], 'w', zipfile.ZIP_DEFLATED)
+        f.writestr('data.csv', self.data)
+        f.close()
+        return names
+
+    def test_reads_like_a_file(self):
+        lines = self.data.splitlines(True)
+        for name in self._compressed():
+            f = utils.open_csv(name)
+            self.assertEqual(lines, list(f))
+            self.assertEqual(len(self.data), f.tell())
+            # Offsets are offsets in the decompressed content, as for rows:
+            f.seek(0)
+            reader = utils.OffsetDictReader(f, skipinitialspace=True)
+            rows = [(reader.offset, row) for row in reader]
+            for offset, row in reversed(rows[::50]):
+                self.assertEqual(row, reader.row_at(offset))
+            f.seek(2500)
+            self.assertEqual(self.data[2500:4000], f.read(1500))
+            self.assertEqual(self.data[4000:].splitlines(True)[0], f.readline())
+            f.seek(3)
+            self.assertEqual(self.data[3:], f.read())
+            self.assertEqual('', f.read(10))
+            self.assertEqual('', f.readline())
+            f.close()
+
+    def test_errors(self):
+        name = os.path.join(self.dir, 'data.zip')
+        f = zipfile.ZipFile(name, 'w')
+        f.writestr('a.csv', self.data)
+        f.writestr('b.csv', self.data)
+        f.close()
+        self.assertRaises(ValueError, utils.open_csv, name)
+        name = os.path.join(self.dir, 'data.csv.gz')
+        f = open(name, 'wb')
+        f.write('not gzip' * 1000)
+        f.close()
+        f = utils.open_csv(name)
+        self.assertRaises(IOError, f.read)
+        f.close()
+
+class UnicodeDictReaderTest(unittest.TestCase):
+
+    def test_encodings(self):
+        data = u'id,pa\xeds,notes\r\n1,m\xe9xico,"a,\nb"\r\n2,\u20ac,\x1f\r\n'
+        for encoding in ['utf-8', 'cp1252', 'utf-16', 'utf-8-sig']:
+            f = tempfile.TemporaryFile()
+            f.write(data.encode(encoding))
+            f.seek(0)
+            reader = utils.UnicodeDictReader(f, encoding=encoding)
+            self.assertEqual(['id', 'pa\xc3\xads', 'notes'], reader.fieldnames)
+            self.assertEqual([{'id': u'1', 'pa\xc3\xads': u'm\xe9xico', 'notes': u'a,\nb'},
+                              {'id': u'2', 'pa\xc3\xads': u'\u20ac', 'notes': u'\x1f'}],
+                             list(reader))
+
+    def test_is_bytewise(self):
+        for encoding in ['utf-8', 'UTF8', 'ascii', 'latin-1', 'cp1252', 'iso-8859-15']:
+            self.assertTrue(utils.is_bytewise(encoding))
+        for encoding in ['utf-16', 'utf-8-sig', 'shift_jis', 'gbk', 'iso-2022-jp']:
+            self.assertFalse(utils.is_bytewise(encoding))
+
+class UnicodeDictWriterTest(unittest.TestCase):
+
+    def _write(self, rows, encoding, write, buffer_size=0):
+        f = tempfile.TemporaryFile()
+        writer = utils.UnicodeDictWriter(f, ['id', u'pa\xeds'], encoding=encoding,
+                                         buffer_size=buffer_size)
+        writer.writeheader()
+        write(writer, rows)
+        if buffer_size:
+            writer.flush()
+        f.seek(0)
+        return f.read()
+
+    def test_buffered_output_is_unchanged(self):
+        rows = [{'id': u'%s' % i, 'pa\xc3\xads': u'm\xe9xico, "%s"\n\u20ac' % i} for i in range(100)]
+        def writerow(writer, rows):
+            for row in rows:
+                writer.writerow(row)
+        def writerows(writer, rows):
+            writer.writerows(iter(rows))
+        for encoding in ['utf-8', 'utf-16', 'cp1252']:
+            # Unbuffered writers write every row without a flush:
+            expected = self._write(rows, encoding, writerow)
+            self.assertEqual(u'id,pa\xeds\r\n', expected.decode(encoding)[:9].lstrip(u'\ufeff'))
+            self.assertEqual(101, expected.decode(encoding).count(u'\r\n'))
+            self.assertEqual(expected, self._write(rows, encoding, writerows))
+            for size in [1, 100, 10 ** 6]:
+                self.assertEqual(expected, self._write(rows, encoding, writerow, size))
+                self.assertEqual(expected, self._write(rows, encoding, writerows, size))
+            # The header is not written without rows:
+            for size in [0, 10 ** 6]:
+                self.assertEqual('', self._write([], encoding, writerows, size))
+
+class EncodingTest(unittest.TestCase):
+
+    def _detect(self, data, size=utils.SAMPLE_SIZE):
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(10)
+        encoding = utils.detect_encoding(f, size)
+        self.assertEqual(0, f.tell())
+        return encoding
+
+    def test_detect_encoding(self):
+        text = u'id,country\n1,m\xe9xico\n2,\u20ac\n'
+        self.assertEqual('utf-8', self._detect(text.encode('utf-8')))
+        self.assertEqual('utf-16', self._detect(text.encode('utf-16')))
+        self.assertEqual('cp1252', self._detect(text.encode('cp1252')))
+        self.assertEqual('latin-1', self._detect(text.encode('cp1252') + '\x81'))
+        # Samples are spread over files larger than the sample size, and cut
+        # characters at both ends:
+        data = (u'\xe9' * 10000 + u'\n').encode('utf-8') * 100
+        self.assertEqual('utf-8', self._detect(data, 16 * 999))
+        self.assertEqual('cp1252', self._detect(data + '\xe9\n', 16 * 999))
+
+    def test_row_decoder(self):
+        decoder = utils.RowDecoder()
+        self.assertEqual('cp1252', decoder.fallback)
+        self.assertEqual((u'm\xe9xico', u'\u20ac'), decoder(['m\xc3\xa9xico', '\xe2\x82\xac']))
+        self.assertEqual((u'm\xe9xico', u'\u20ac'), decoder(['m\xe9xico', '\x80']))
+        self.assertEqual(1, decoder.fallbacks)
+        # Bytes cp1252 leaves undefined are decoded as latin-1:
+        self.assertEqual((u'a', u'\x81b'), decoder(['a', '\x81b']))
+        self.assertEqual(2, decoder.fallbacks)
+        self.assertEqual((u'\x80',), utils.RowDecoder('latin-1')(['\x80']))
+        self.assertRaises(ValueError, utils.RowDecoder, 'utf-16')
+
+    def test_transcode(self):
+        text = u'id,country\n1,m\xe9xico\n' * 1000
+        f = tempfile.TemporaryFile()
+        f.write(text.encode('utf-16'))
+        f.seek(0)
+        out = tempfile.TemporaryFile()
+        utils.transcode(f, 'utf-16', out, blocksize=100)
+        out.seek(0)
+        self.assertEqual(text.encode('utf-8'), out.read())
+
+class DecodeRowTest(unittest.TestCase):
+
+    def test_decode_row(self):
+        row = ['1', 'M\xc3\xa9xico', '', 'a\x1fb']
+        self.assertEqual((u'1', u'M\xe9xico', u''), utils.decode_row(row[:3]))
+        # Values containing the separator are decoded one by one:
+        self.assertEqual((u'1', u'M\xe9xico', u'', u'a\x1fb'), utils.decode_row(row))
+        self.assertEqual((), utils.decode_row([]))
+        self.assertRaises(UnicodeDecodeError, utils.decode_row, ['\xe9'])
+
+class DigestSetTest(unittest.TestCase):
+
+    def test_digest_set(self):
+        digests = utils.DigestSet(capacity=8)
+        keys = ['key%s' % i for i in range(5000)]
+        for key in keys:
+            self.assertTrue(digests.add(key))
+        self.assertEqual(5000, len(digests))
+        self.assertTrue(len(digests.table) < 5000 * 2)
+        for key in keys:
+            self.assertFalse(digests.add(key))
+            self.assertTrue(key in digests)
+        self.assertFalse('key5000' in digests)
+        self.assertEqual(5000, len(digests))
+
+class ChunkCsvTest(unittest.TestCase):
+
+    def test_chunks_are_content_defined(self):
+        f = open(DATA_CSV, 'rb')
+        data = f.read()
+        chunks = utils.chunk_csv(f, mask=3)
+        f.close()
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual(os.path.getsize(DATA_CSV), chunks[-1][1])
+        for (start, end, digest), (next_start, next_end, next_digest) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual('\n', data[end - 1])
+
+        # Editing a record in the middle only changes the chunk around it:
+        start, end, digest = chunks[len(chunks) / 2]
+        edited = tempfile.TemporaryFile()
+        edited.write(data[:start] + 'x' + data[start:])
+        edited_chunks = utils.chunk_csv(edited, mask=3)
+        digests = set(x[2] for x in chunks)
+        changed = [x for x in edited_chunks if x[2] not in digests]
+        self.assertTrue(1 <= len(changed) <= 2)
+        self.assertEqual(start, changed[0][0])
+
+    def test_quoted_newlines(self):
+        f = tempfile.TemporaryFile()
+        f.write('id,"a\nb"\n' + ''.join('%s,"x\n%s"\n' % (i, i) for i in range(100)))
+        for start, end, digest in utils.chunk_csv(f, mask=1):
+            f.seek(start)
+            self.assertEqual('"\n', f.read(end - start)[-2:])
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    unittest.main()
@@ -18,17 +18,26 @@
 """This module provides unittesting coverage for vn.py script."""
 
 # Fixes path for testing:
-import test_util
-test_util.fix_sys_path()
+import test_setup
 
+import csv
+import gzip
 import logging
 import os
+import shutil
 import simplejson
 import sqlite3
 import tempfile
 import unittest
+import zipfile
 
-from vn import DeltaProcessor
+from dce import deltas
+from dce import dwca
+from dce import partitions
+from dce import rechash
+from dce import records
+from dce import schema
+from dce.deltas import DeltaProcessor
 
 class Options(object):
     """Class that simulates OptParser options object."""
@@ -40,10 +49,11 @@ class DeltaProcessorTest(unittest.TestCase):
     
     def setUp(self):
 
-        try:
-            os.remove('bulk.sqlite3.db')
-        except:
-            pass
+        for name in ['bulk.sqlite3.db', 'bulk.sqlite3.db-wal', 'bulk.sqlite3.db-shm']:
+            try:
+                os.remove(name)
+            except:
+                pass
 
         self.new_data = """occurrenceid,country
 1,usa
@@ -66,6 +76,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))    
         dp = DeltaProcessor(options)
@@ -86,6 +97,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))        
         dp = DeltaProcessor(options)
@@ -107,6 +119,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))        
         dp = DeltaProcessor(options)
@@ -128,6 +141,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))    
         dp = DeltaProcessor(options)
@@ -151,6 +165,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))        
         dp = DeltaProcessor(options)
@@ -172,6 +187,7 @@ class DeltaProcessorTest(unittest.TestCase):
                 publisher_name='p', 
                 collection_name='c', 
                 batch_size=10000,
+                source_id='occurrenceid',
                 verbosity=1,
                 csv_file=data_csv.name))    
         dp = DeltaProcessor(options)
@@ -187,6 +203,528 @@ class DeltaProcessorTest(unittest.TestCase):
                 self.assertEqual('new', row[0])
         conn.close()
 
+    def _deltas(self, data, **kwds):
+        """Runs deltas on data and returns cache rows keyed by reckey."""
+        data_csv = tempfile.NamedTemporaryFile()
+        data_csv.write(data)
+        data_csv.flush()
+        opts = dict(
+            publisher_name='p',
+            collection_name='c',
+            batch_size=10000,
+            source_id='occurrenceid',
+            verbosity=1,
+            csv_file=data_csv.name)
+        opts.update(kwds)
+        dp = DeltaProcessor(Options(opts))
+        self.counts = dp.deltas()
+        rows = dp.conn.execute('select reckey, rechash, recjson, recstate, hashversion, recfields from cache')
+        cache = dict((row[0], row[1:]) for row in rows)
+        dp.close()
+        return cache
+
+    def test_two_phase_deltas(self):
+        data = 'occurrenceid,country,notes\n1,m\xc3\xa9xico,"a\nb"\n2,china,\n3,russia,'
+        changed = data.replace('china', 'prc') + '\n4,chile,'
+        self._deltas(data)
+        expected = self._deltas(changed)
+        self.setUp()
+        self._deltas(data, two_phase=True)
+        self.assertEqual(expected, self._deltas(changed, two_phase=True))
+
+        # Only the updated and new rows were built:
+        conn = sqlite3.connect('bulk.sqlite3.db')
+        recjson = [x[0] for x in conn.execute('select recjson from tmp')]
+        conn.close()
+        built = sorted(simplejson.loads(x)['country'] for x in recjson if x)
+        self.assertEqual(['chile', 'prc'], built)
+        self.assertEqual(2, recjson.count(None))
+
+    def test_legacy_hashes_migrate_without_updates(self):
+        data = 'occurrenceid,country\n1,usa\n2,china'
+        self._deltas(data)
+
+        # Rewrites the cache as if it was hashed with version 1:
+        conn = sqlite3.connect('bulk.sqlite3.db')
+        for oid, country in [(u'1', u'usa'), (u'2', u'china')]:
+            legacy = rechash.legacy_hash(dict(occurrenceid=oid, country=country))
+            conn.execute(
+                "update cache set rechash=?, hashversion=1, recstate='published' where recjson like ?", 
+                (legacy, '%%"%s"%%' % country))
+        conn.commit()
+        conn.close()
+
+        cache = self._deltas(data.replace('china', 'prc'))
+        states = sorted((simplejson.loads(x[1])['country'], x[2]) for x in cache.values())
+        self.assertEqual([('prc', 'updated'), ('usa', 'published')], states)
+        for x in cache.values():
+            self.assertEqual(rechash.CURRENT_VERSION, x[3])
+
+    def test_schema_drift_is_not_an_update(self):
+        self._deltas('occurrenceid,genus,country\nH-1,bufo,china\nF-1,salmo,united states')
+        cache = self._deltas(
+            'occurrenceid,genus,country,notes\nH-1,Bufo,China,x\nF-1,salmo, United  States ,y')
+        self.assertEqual(dict(new=0, updated=0, deleted=0, spurious=2), self.counts)
+        self.assertEqual(['new', 'new'], [x[2] for x in cache.values()])
+
+        # The raw hash is kept current, so the same file again avoids nothing:
+        self._deltas('occurrenceid,genus,country,notes\nH-1,Bufo,China,x\nF-1,salmo, United  States ,y')
+        self.assertEqual(0, self.counts['spurious'])
+
+    def test_column_plan_matches_row_hashes(self):
+        f = open(os.path.join(test_setup.DIR_PATH, 'app', 'data.csv'), 'rb')
+        reader = deltas.OffsetDictReader(f, skipinitialspace=True)
+        # A repeated column and a short name for a concept already present:
+        fieldnames = reader.fieldnames + ['Country', 'cty']
+        plan = rechash.ColumnPlan(fieldnames)
+        processor = deltas.RowProcessor(
+            Options(dict(publisher_name='p', collection_name='c', source_id='occurrenceid')), [])
+        processor.plan = plan
+        for i in range(200):
+            values = reader.nextvalues() + (u' Fiji ', u'chile')
+            row = dict(zip([x.lower() for x in fieldnames], values))
+            self.assertEqual(row, plan.row(values))
+            self.assertEqual(rechash.normalize(row), plan.normalize(values))
+            self.assertEqual(rechash.rechash(row, rechash.RAW_VERSION), plan.rawhash(values))
+            self.assertEqual(rechash.rechash_fields(row), plan.rechash_fields(values))
+            self.assertEqual(processor.get_rec(row), processor.get_planned_rec(values))
+        f.close()
+
+    def test_duplicate_source_ids(self):
+        data = 'occurrenceid,country\n1,usa\n2,china\nA,chile\n1,peru\na,fiji\n1,fiji'
+        def countries(cache):
+            return sorted(simplejson.loads(x[1])['country'] for x in cache.values())
+        self.assertEqual(['china', 'fiji', 'fiji'], countries(self._deltas(data)))
+        for opts in [{}, dict(engine='sortmerge'), dict(workers=2, batch_size=2)]:
+            self.setUp()
+            range_size = deltas.RANGE_SIZE
+            deltas.RANGE_SIZE = 10
+            try:
+                cache = self._deltas(data, drop_duplicates=True, **opts)
+            finally:
+                deltas.RANGE_SIZE = range_size
+            self.assertEqual(['chile', 'china', 'usa'], countries(cache))
+            self.assertEqual(3, self.counts['new'])
+
+    def test_workers_are_deterministic(self):
+        lines = ['occurrenceid,country,year'] + \
+            ['%s,country %s,%s' % (i % 40, i, 1900 + i) for i in range(100)]
+        data = '\n'.join(lines)
+        range_size = deltas.RANGE_SIZE
+        deltas.RANGE_SIZE = 100
+        try:
+            expected = self._deltas(data, batch_size=7)
+            self.setUp()
+            self.assertEqual(expected, self._deltas(data, batch_size=7, workers=3))
+        finally:
+            deltas.RANGE_SIZE = range_size
+        self.assertEqual(40, len(expected))
+
+    def test_worker_write_errors_are_raised(self):
+        data = '\n'.join(['occurrenceid,country'] + ['%s,country %s' % (i, i) for i in range(200)])
+        def fail(*args):
+            raise IOError('Disk full')
+        range_size = deltas.RANGE_SIZE
+        insertchunk = DeltaProcessor.TmpTable._insertchunk
+        deltas.RANGE_SIZE = 100
+        DeltaProcessor.TmpTable._insertchunk = fail
+        try:
+            self.assertRaises(IOError, self._deltas, data, workers=2)
+        finally:
+            deltas.RANGE_SIZE = range_size
+            DeltaProcessor.TmpTable._insertchunk = insertchunk
+
+    def test_compressed_input(self):
+        lines = ['occurrenceid,country,year'] + \
+            ['%s,"country\n%s",%s' % (i % 40, i, 1900 + i) for i in range(100)]
+        data = '\n'.join(lines)
+        expected = self._deltas(data)
+        name = os.path.join(tempfile.mkdtemp(), 'data.csv.gz')
+        f = gzip.open(name, 'wb')
+        f.write(data)
+        f.close()
+        range_size = deltas.RANGE_SIZE
+        deltas.RANGE_SIZE = 100
+        try:
+            for opts in [{}, dict(two_phase=True), dict(engine='sortmerge', two_phase=True),
+                         dict(workers=3)]:
+                self.setUp()
+                self.assertEqual(expected, self._deltas('', csv_file=name, **opts))
+        finally:
+            deltas.RANGE_SIZE = range_size
+            shutil.rmtree(os.path.dirname(name))
+        # Workers and sort-merge two-phase runs read a decompressed copy:
+        self.assertTrue(os.path.exists(deltas.INPUT_FILE))
+        os.remove(deltas.INPUT_FILE)
+
+    def test_encodings(self):
+        lines = [u'occurrenceid,country,year'] + \
+            [u'%s,"m\xe9xico\n%s",%s' % (i, i, 1900 + i) for i in range(60)]
+        text = u'\n'.join(lines)
+        expected = self._deltas(text.encode('utf-8'))
+        # Rows of older systems in cp1252 mixed with UTF-8 rows:
+        mixed = '\n'.join(x.encode('cp1252' if i % 3 else 'utf-8') for i, x in enumerate(lines))
+        range_size = deltas.RANGE_SIZE
+        deltas.RANGE_SIZE = 100
+        try:
+            for data, opts in [(mixed, {}), (mixed, dict(workers=3)), (mixed, dict(chunked=True)),
+                               (text.encode('latin-1'), dict(encoding='latin-1')),
+                               (text.encode('latin-1'), dict(encoding='latin-1', workers=3)),
+                               (text.encode('utf-16'), {}),
+                               (text.encode('utf-16'), dict(engine='sortmerge', two_phase=True))]:
+                self.setUp()
+                self.assertEqual(expected, self._deltas(data, **opts))
+        finally:
+            deltas.RANGE_SIZE = range_size
+        os.remove(deltas.INPUT_FILE)
+
+    def test_worker_fallbacks_are_counted(self):
+        lines = [u'occurrenceid,country'] + [u'%s,m\xe9xico' % i for i in range(60)]
+        mixed = '\n'.join(x.encode('cp1252' if i % 3 else 'utf-8') for i, x in enumerate(lines))
+        warnings = []
+        warning = logging.warning
+        logging.warning = lambda msg, *args: warnings.append(msg)
+        range_size = deltas.RANGE_SIZE
+        deltas.RANGE_SIZE = 100
+        try:
+            for workers in [1, 2]:
+                self.setUp()
+                del warnings[:]
+                self._deltas(mixed, workers=workers)
+                self.assertTrue('40 rows are not UTF-8 and were read as cp1252' in warnings)
+        finally:
+            logging.warning = warning
+            deltas.RANGE_SIZE = range_size
+
+    def test_sortmerge_engine_is_equivalent(self):
+        header = 'occurrenceid,country,notes\n'
+        runs = [
+            (header + '1,usa,\n2,china,\n3,russia,\n4,chile,\n5,peru,\n1,usa,x', {}),
+            (header + '1,usa,\n2,prc,\n4,chile,\n5,Peru ,y\n6,fiji,', {}),
+            (header + '2,prc,\n3,russia,\n5,peru,\n6,tonga,', dict(two_phase=True)),
+            (header + '2,prc,\n3,russia,\n5,peru,\n6,tonga,', dict(workers=2)),
+            (header, {})]
+        run_size = deltas.SORT_RUN_SIZE
+        deltas.SORT_RUN_SIZE = 2
+        try:
+            results = {}
+            for engine in ['sqlite', 'sortmerge']:
+                self.setUp()
+                results[engine] = []
+                for data, kwds in runs:
+                    cache = self._deltas(data, engine=engine, **kwds)
+                    results[engine].append((cache, self.counts))
+        finally:
+            deltas.SORT_RUN_SIZE = run_size
+        self.assertEqual(results['sqlite'], results['sortmerge'])
+        self.assertEqual(dict(new=0, updated=0, deleted=6, spurious=0), results['sqlite'][-1][1])
+
+    def test_updated_fields(self):
+        header = 'occurrenceid,genus,habitat,fieldnotes\n'
+        for engine in ['sqlite', 'sortmerge']:
+            self.setUp()
+            self._deltas(header + '1,bufo,pond,a\n2,salmo,river,b', engine=engine)
+            conn = sqlite3.connect('bulk.sqlite3.db')
+            conn.execute("update cache set recstate='published'")
+            conn.commit()
+            conn.close()
+            cache = self._deltas(header + '1,bufo,lake,a\n2,salmo,river,c', engine=engine)
+            fields = sorted(x[4] for x in cache.values())
+            self.assertEqual(['fieldnotes', 'habitat'], fields)
+
+            # Changes accumulate until published:
+            cache = self._deltas(header + '1,Rana,lake,a\n2,salmo,river,c', engine=engine)
+            fields = sorted(x[4] for x in cache.values())
+            self.assertEqual(['fieldnotes', 'genus,habitat'], fields)
+
+    def test_resume_after_interrupted_ingest(self):
+        lines = ['occurrenceid,country'] + ['%s,country %s' % (i, i) for i in range(50)]
+        data = '\n'.join(lines)
+        expected = self._deltas(data)
+        self.setUp()
+
+        parsed = []
+        process = deltas.RowProcessor.__call__
+        insertchunk = DeltaProcessor.TmpTable._insertchunk
+        def count(processor, rows):
+            parsed.extend(offset for offset, row in rows)
+            return process(processor, rows)
+        def crash(table, *args):
+            if table.totalcount > 20:
+                raise RuntimeError('Interrupted')
+            insertchunk(table, *args)
+        # Batches of 7 rows, each committed:
+        checkpoint_seconds = deltas.CHECKPOINT_SECONDS
+        deltas.CHECKPOINT_SECONDS = 0
+        deltas.RowProcessor.__call__ = count
+        DeltaProcessor.TmpTable._insertchunk = crash
+        try:
+            data_csv = tempfile.NamedTemporaryFile()
+            data_csv.write(data)
+            data_csv.flush()
+            self.assertRaises(RuntimeError, self._deltas, data, csv_file=data_csv.name,
+                              batch_size=7)
+            self.assertEqual(21, len(parsed))
+            DeltaProcessor.TmpTable._insertchunk = insertchunk
+            # Other actions, such as report, keep the checkpoint:
+            DeltaProcessor(Options(dict(csv_file=None))).close()
+            cache = self._deltas(data, csv_file=data_csv.name, resume=True, batch_size=7)
+        finally:
+            deltas.CHECKPOINT_SECONDS = checkpoint_seconds
+            deltas.RowProcessor.__call__ = process
+            DeltaProcessor.TmpTable._insertchunk = insertchunk
+        self.assertEqual(expected, cache)
+        self.assertEqual(dict(new=50, updated=0, deleted=0, spurious=0), self.counts)
+        # Only the chunk that was not committed is parsed again:
+        self.assertEqual(57, len(parsed))
+        self.assertEqual(50, len(set(parsed)))
+
+    def test_chunked_runs_skip_unchanged_chunks(self):
+        lines = ['occurrenceid,country'] + ['%s,country %s' % (i, i) for i in range(200)]
+        edited = list(lines)
+        edited[100] = '99,edited'
+        edited.insert(150, '500,inserted')
+        del edited[20]
+        runs = ['\n'.join(lines), '\n'.join(edited), '\n'.join(edited), '\n'.join(lines)]
+        # A repeated source_id only leaves a cache row in its last chunk:
+        repeated = lines[:61]
+        repeated.insert(55, '5,c5')
+        sequences = [runs, ['\n'.join(lines[:61]), '\n'.join(repeated), '\n'.join(lines[:61])]]
+        expected = []
+        for runs in sequences:
+            self.setUp()
+            for data in runs:
+                expected.append((self._deltas(data), self.counts))
+
+        parsed = []
+        process = deltas.RowProcessor.__call__
+        def count(processor, rows):
+            parsed.extend(rows)
+            return process(processor, rows)
+        chunk_mask = deltas.CHUNK_MASK
+        deltas.CHUNK_MASK = 3
+        deltas.RowProcessor.__call__ = count
+        try:
+            results = []
+            for runs in sequences:
+                self.setUp()
+                for data in runs:
+                    del parsed[:]
+                    results.append((self._deltas(data, chunked=True), self.counts))
+                    if len(results) == 3:
+                        # Rerunning the same file parses nothing:
+                        self.assertEqual([], parsed)
+                    elif len(results) == 2:
+                        self.assertTrue(0 < len(parsed) < 100)
+        finally:
+            deltas.CHUNK_MASK = chunk_mask
+            deltas.RowProcessor.__call__ = process
+        self.assertEqual(expected, results)
+        self.assertEqual(0, results[-1][1]['deleted'])
+
+    def test_compact_records(self):
+        data = 'occurrenceid,country,notes\n1,m\xc3\xa9xico,"a\nb"\n2,china,\n3,russia,'
+        changed = data.replace('china', 'prc') + '\n4,chile,'
+        self._deltas(data)
+        expected = self._deltas(changed)
+        for kwds in [dict(compact='zlib'), dict(compact='dictionary', two_phase=True),
+                     dict(compact='dictionary', engine='sortmerge', workers=2)]:
+            self.setUp()
+            self._deltas(data, **kwds)
+            cache = self._deltas(changed, **kwds)
+            codec = records.RecordCodec.load(sqlite3.connect('bulk.sqlite3.db'))
+            for reckey, row in cache.items():
+                self.assertTrue(isinstance(row[1], buffer))
+                self.assertEqual(simplejson.loads(expected[reckey][1]), codec.decode(row[1]))
+                self.assertEqual(expected[reckey][2:], row[2:])
+
+            report_dir = tempfile.mkdtemp()
+            try:
+                filename = os.path.join(report_dir, 'report.csv')
+                dp = DeltaProcessor(Options(dict(csv_file=None)))
+                dp.Report(dp.conn, dp.options, filename).execute()
+                dp.close()
+                report = open(filename).read()
+                self.assertTrue('m\\u00e9xico' in report)
+                self.assertTrue('prc' in report)
+            finally:
+                shutil.rmtree(report_dir)
+
+    def test_iter_changes(self):
+        self._deltas('occurrenceid,country,year\n1,usa,1990\n2,china,\n3,russia,')
+        data_csv = tempfile.NamedTemporaryFile()
+        data_csv.write('occurrenceid,country,year\n1,usa,1991\n3,russia,\n4,chile,')
+        data_csv.flush()
+        batch_size = deltas.BATCH_SIZE
+        deltas.BATCH_SIZE = 1
+        try:
+            dp = DeltaProcessor(Options(dict(
+                publisher_name='p', collection_name='c', source_id='occurrenceid',
+                csv_file=data_csv.name)))
+            dp.conn.execute("update cache set recstate='published'")
+            dp.conn.commit()
+            dp.deltas()
+            changes = []
+            for change in dp.iter_changes():
+                changes.append(change)
+                # Consumers can write to the cache while iterating:
+                dp.conn.execute("update cache set recstate='published' where reckey=?",
+                                (change.reckey,))
+                dp.conn.commit()
+        finally:
+            deltas.BATCH_SIZE = batch_size
+        changes = sorted((x.rec.get('country'), x.recstate, x.recfields) for x in changes)
+        self.assertEqual([('chile', 'new', None), ('china', 'deleted', None),
+                          ('usa', 'updated', ('year',))], changes)
+        self.assertEqual([], list(dp.iter_changes()))
+        self.assertEqual(4, len(list(dp.iter_changes(states=None))))
+        change = list(dp.iter_changes(states=['published']))[0]
+        self.assertEqual(40, len(change.rechash))
+        dp.close()
+
+    def test_report_options(self):
+        self._deltas('occurrenceid,country,year\n1,usa,1990\n2,china,\n3,russia,')
+        conn = sqlite3.connect('bulk.sqlite3.db')
+        conn.execute("update cache set recstate='published' where recjson like '%usa%'")
+        conn.commit()
+        conn.close()
+        report_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(report_dir, 'report.csv')
+            dp = DeltaProcessor(Options(dict(csv_file=None)))
+            dp.Report(dp.conn, Options(dict()), filename).execute()
+            rows = list(csv.DictReader(open(filename)))
+            self.assertEqual(3, len(rows))
+            # Empty values are dropped:
+            recs = [simplejson.loads(x['recjson']) for x in rows]
+            self.assertTrue(dict(country='china', occurrenceid='2') in recs)
+
+            report = dp.Report(dp.conn, Options(dict(
+                        states='new', report_format='ndjson', gzip=True, part_size=1)), filename)
+            report.execute()
+            self.assertEqual(['report-00001.ndjson.gz', 'report-00002.ndjson.gz'],
+                             [os.path.basename(x) for x in report.filenames])
+            lines = [simplejson.loads(gzip.open(x).read()) for x in report.filenames]
+            self.assertEqual(['new', 'new'], [x['recstate'] for x in lines])
+            for line in lines:
+                self.assertEqual(dict, type(line['rec']))
+
+            # Compressed parts are sized by the compressed bytes:
+            size = os.path.getsize(filename)
+            report = dp.Report(dp.conn, Options(dict(gzip=True, part_size=size / 2)), filename)
+            report.execute()
+            self.assertEqual(1, len(report.filenames))
+            self.assertEqual(rows, list(csv.DictReader(gzip.open(report.filenames[0]))))
+
+            # Rows buffered by the CSV writer count towards the part size:
+            report = dp.Report(dp.conn, Options(dict(part_size=1)), filename)
+            report.execute()
+            parts = [list(csv.DictReader(open(x))) for x in report.filenames]
+            self.assertEqual([1, 1, 1], [len(x) for x in parts])
+            self.assertEqual(sorted(rows), sorted(x[0] for x in parts))
+
+            # A report without rows has no header either:
+            dp.Report(dp.conn, Options(dict(states='updated')), filename).execute()
+            self.assertEqual('', open(filename).read())
+            dp.close()
+        finally:
+            shutil.rmtree(report_dir)
+
+    def test_partitioned_caches(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self._deltas('occurrenceid,country\n1,usa\n2,china', cache_dir=cache_dir)
+            self._deltas('occurrenceid,country\n1,usa', cache_dir=cache_dir,
+                         collection_name='c/2')
+            cache = self._deltas('occurrenceid,country\n1,usa\n2,prc', cache_dir=cache_dir)
+            self.assertEqual(['new', 'updated'], sorted(x[2] for x in cache.values()))
+            self.assertFalse(os.path.exists('bulk.sqlite3.db'))
+
+            rows = partitions.catalog(cache_dir)
+            self.assertEqual([('p', 'c'), ('p', 'c/2')], [x[:2] for x in rows])
+            self.assertEqual(os.path.join(cache_dir, 'p', 'c%2F2'), rows[1][2])
+
+            # A second run on a locked collection exits:
+            partition = partitions.Partition(cache_dir, 'p', 'c').lock()
+            try:
+                self.assertRaises(SystemExit, self._deltas, 'occurrenceid\n1',
+                                  cache_dir=cache_dir)
+                self._deltas('occurrenceid,country\n1,usa', cache_dir=cache_dir,
+                             collection_name='c/2')
+            finally:
+                partition.unlock()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_darwin_core_archive(self):
+        fd, archive = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        meta = '''<archive xmlns="http://rs.tdwg.org/dwc/text/">
+  <core fieldsTerminatedBy="\\t" fieldsEnclosedBy="" ignoreHeaderLines="1">
+    <files><location>occurrence.txt</location></files>
+    <id index="0"/>
+    <field index="1" term="http://rs.tdwg.org/dwc/terms/country"/>
+  </core>
+  <extension rowType="http://rs.tdwg.org/dwc/terms/Identification">
+    <files><location>identification.txt</location></files>
+    <coreid index="0"/>
+    <field index="1" term="http://rs.tdwg.org/dwc/terms/scientificName"/>
+  </extension>
+</archive>'''
+        def write(core, extension):
+            z = zipfile.ZipFile(archive, 'w')
+            z.writestr('meta.xml', meta)
+            z.writestr('occurrence.txt', core)
+            z.writestr('identification.txt', extension)
+            z.close()
+        try:
+            write('id\tcountry\n1\tusa\n2\tchina', '2,Puma\n1,Lynx\n2,Felis')
+            cache = self._deltas('', dwca=archive, source_id=None)
+            self.assertEqual(2, self.counts['new'])
+            recs = sorted(simplejson.loads(x[1]) for x in cache.values())
+            # The core id is the source_id:
+            self.assertEqual([{'country': 'china', 'scientificname': 'Puma | Felis'},
+                              {'country': 'usa', 'scientificname': 'Lynx'}], recs)
+            write('id\tcountry\n1\tusa\n2\tchina', '2,Puma\n1,Lynx')
+            self._deltas('', dwca=archive, source_id=None)
+            self.assertEqual((0, 1, 0), (self.counts['new'], self.counts['updated'],
+                                         self.counts['deleted']))
+        finally:
+            os.remove(archive)
+            os.remove(dwca.FLAT_FILE)
+
+    def test_setupdb_migrates_legacy_cache(self):
+        conn = sqlite3.connect('bulk.sqlite3.db')
+        conn.execute('create table cache (reckey text, rechash text, recjson text, recstate text)')
+        conn.execute('create table tmp (reckey text, rechash text, recjson text)')
+        conn.executemany('insert into cache values (?, ?, ?, ?)', [
+                ('a', 'h1', '{}', 'new'),
+                ('b', 'h2', '{}', 'published'),
+                ('a', 'h3', '{}', 'updated')])
+        conn.commit()
+        conn.close()
+
+        conn = DeltaProcessor.setupdb()
+        self.assertEqual(schema.SCHEMA_VERSION, schema.get_version(conn))
+        self.assertEqual('wal', conn.execute('pragma journal_mode').fetchone()[0])
+        rows = conn.execute('select reckey, rechash, recstate from cache order by reckey').fetchall()
+        self.assertEqual([('a', 'h3', 'updated'), ('b', 'h2', 'published')], rows)
+        self.assertRaises(
+            sqlite3.IntegrityError, conn.execute, 
+            "insert into cache (reckey, rechash) values ('b', 'h4')")
+        plan = conn.execute("explain query plan select * from cache where reckey='a'").fetchall()
+        self.assertTrue('sqlite_autoindex_cache' in str(plan))
+        # Wide rows of recjson are kept in rowid tables:
+        sql = dict(conn.execute("select name, sql from sqlite_master where type='table'"))
+        for name in ['cache', 'tmp']:
+            self.assertFalse('without rowid' in sql[name].lower())
+        conn.close()
+
+        # Opening an up to date cache is a no-op:
+        conn = DeltaProcessor.setupdb()
+        self.assertEqual(2, conn.execute('select count(*) from cache').fetchone()[0])
+        conn.close()
+
 if __name__ == '__main__':
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
@@ -190,12 +190,27 @@ def get_rec_json():
         return db.Text(simplejson.dumps(rec))
     return wrapper
 
+def needs_reindex(recfields):
+    """Returns True unless recfields, the comma separated Darwin Core names
+    changed by an update, are all in DO_NOT_INDEX and DO_NOT_FULL_TEXT. Empty
+    recfields means the changed names are unknown."""
+    if not recfields:
+        return True
+    for name in recfields.split(','):
+        if name not in DO_NOT_INDEX or name not in DO_NOT_FULL_TEXT:
+            return True
+    return False
+
 def add_dynamic_properties(input_dict, instance, bulkload_state_copy):    
     """Adds dynamic properties from the CSV input_dict to the entity instance."""
 
     # Ingore deleted records
     if input_dict['recstate'] == 'deleted':
         return datastore.Entity('RecordIndex')
+
+    # Ignore updates that only changed fields neither indexed nor in the corpus
+    if input_dict['recstate'] == 'updated' and not needs_reindex(input_dict.get('recfields')):
+        return datastore.Entity('RecordIndex')
     
     # Populate dynamic properties using Darwin Core short names
     recjson = simplejson.loads(input_dict['recjson'].encode('utf-8'))
@@ -24,7 +24,7 @@ verbosity = 1
 
 # DCE modules
 from dce.utils import *
-from dce.deltas import DeltaProcessor
+from dce.deltas import CHECKPOINT_SECONDS, DeltaProcessor
 from dce.bulkload import Bulkload
 
 # Standard Python modules
@@ -53,6 +53,15 @@ def StatusUpdate(msg):
 def ErrorUpdate(msg):
     PrintUpdate('ERROR: %s' % msg)
 
+def _PartitionOptions(self, parser):
+    parser.add_option('-p', '--publisher_name', type='string', dest='publisher_name',
+                      metavar='PUBLISHER', help='VertNet publisher name.')
+    parser.add_option('-c', '--collection_name', type='string', dest='collection_name',
+                      metavar='COLLECTION', help='VertNet publisher collection name.')
+    parser.add_option('--cache_dir', type='string', dest='cache_dir',
+                      metavar='DIR', help='Directory of caches partitioned by '
+                      'publisher and collection, instead of bulk.sqlite3.db.')
+
 def _BulkloadOptions(self, parser):
    parser.add_option('--config_file', type='string', dest='config_file',
                      metavar='FILE', help='Bulkload YAML config file.')
@@ -66,22 +75,59 @@ def _BulkloadOptions(self, parser):
                      help='Number of records to pst in each request.')                          
    parser.add_option('-l', '--localhost', dest='localhost', action='store_true', 
                       help='Shortcut for bulkloading to http://localhost:8080/_ah/remote_api')                          
+   _PartitionOptions(self, parser)
 
 def _ReportOptions(self, parser):
-    pass
+    _PartitionOptions(self, parser)
+    parser.add_option('--states', type='string', dest='states', metavar='STATES',
+                      help='Comma separated recstates to report, e.g. new,updated,deleted.')
+    parser.add_option('--report_format', type='choice', dest='report_format',
+                      choices=['csv', 'ndjson'], default='csv',
+                      help='Report as CSV or newline-delimited JSON.')
+    parser.add_option('--gzip', dest='gzip', action='store_true',
+                      help='Compress report files with gzip.')
+    parser.add_option('--part_size', type='int', dest='part_size', metavar='BYTES',
+                      help='Start a new numbered report file after BYTES bytes, '
+                      'compressed bytes with --gzip.')
 
 def _DeltasOptions(self, parser):
     parser.add_option('-b', '--batch_size', type='int', dest='batch_size',
-                      default=10000, metavar='SIZE',
-                      help='Batch size for processing.')
+                      metavar='SIZE', help='Largest batch of rows written at a time. '
+                      'Batches are sized from the observed throughput below it '
+                      '(default 10000).')
     parser.add_option('-f', '--csv_file', type='string', dest='csv_file',
                       metavar='FILE', help='Input CSV file.')
-    parser.add_option('-p', '--publisher_name', type='string', dest='publisher_name',
-                      metavar='PUBLISHER', help='VertNet publisher name.')
-    parser.add_option('-c', '--collection_name', type='string', dest='collection_name',
-                      metavar='COLLECTION', help='VertNet publisher collection name.')
+    parser.add_option('--encoding', type='string', dest='encoding', metavar='ENCODING',
+                      help='Encoding of the CSV file, detected by default. Rows '
+                      'which are not UTF-8 are read in this encoding, or cp1252.')
+    parser.add_option('--dwca', type='string', dest='dwca', metavar='FILE',
+                      help='Input Darwin Core Archive, instead of a CSV file. '
+                      'Its core id is the default source_id.')
+    _PartitionOptions(self, parser)
     parser.add_option('-s', '--source_id', type='string', dest='source_id',
                       metavar='SOURCEID', help='Column name that contains the source record id.')
+    parser.add_option('--two_phase', dest='two_phase', action='store_true',
+                      help='Hash rows first and build JSON only for new or updated rows.')
+    parser.add_option('-w', '--workers', type='int', dest='workers', default=1,
+                      metavar='N', help='Number of processes transforming rows.')
+    parser.add_option('--resume', dest='resume', action='store_true',
+                      help='Continue reading the CSV file after the last checkpoint '
+                      'of an interrupted run. Checkpoints are committed every %s '
+                      'seconds, so up to that many seconds of rows are read again.'
+                      % CHECKPOINT_SECONDS)
+    parser.add_option('--drop_duplicates', dest='drop_duplicates', action='store_true',
+                      help='Keep only the first row of a repeated source_id '
+                      'instead of the last.')
+    parser.add_option('--chunked', dest='chunked', action='store_true',
+                      help='Skip parsing content-defined chunks of the CSV file '
+                      'unchanged since the last chunked run.')
+    parser.add_option('--compact', type='choice', dest='compact',
+                      choices=['zlib', 'dictionary'], metavar='METHOD',
+                      help='Store records with short names, compressed with zlib, '
+                      'or zlib and a dictionary trained on the file.')
+    parser.add_option('--engine', type='choice', dest='engine', default='sqlite',
+                      choices=['sqlite', 'sortmerge'],
+                      help='Delta engine: sqlite joins or an external sort-merge.')
 
 class Action(object):
     """Contains information about a command line action."""
@@ -192,12 +238,14 @@ and deleted records."""))
         StatusUpdate('Report created')
 
     def Deltas(self):
-        csv_file = self.options.csv_file
+        csv_file = self.options.dwca or self.options.csv_file
         if not csv_file:
-            logging.critical('CSV required')
+            logging.critical('CSV or Darwin Core Archive required')
             sys.exit(1)
         StatusUpdate('Calculating deltas for %s' % csv_file)
-        DeltaProcessor(self.options).deltas()
+        counts = DeltaProcessor(self.options).deltas()
+        StatusUpdate('%(new)s new, %(updated)s updated, %(deleted)s deleted, '
+                     '%(spurious)s spurious updates avoided' % counts)
         StatusUpdate('Delta calculation complete')
 
     def _PrintHelpAndExit(self, exit_code=2):